@@ -0,0 +1,286 @@
+import asyncio
+import contextlib
+import time
+import serial
+from bin_to_csv import SnapshotParser
+from simulator import SIMULATOR_SCHEME, SimulatedTinySA
+
+class AsyncTinySA:
+    """
+    asyncio client of a tinySA with the command surface of the tinySA class in scan.py.
+    Commands go through a queue served by one task per device and fail with TimeoutError when the device
+    does not answer in time, instead of blocking the process. The serial port is non-blocking and watched
+    by the event loop (polled for ports without a file descriptor, like the simulator), so one event loop
+    can drive several devices and live consumers without a thread per device.
+
+    scanraw() is an async iterator of snapshots. Commands sent while it runs are interleaved between
+    snapshots: the scan is aborted, the commands run, and the scan restarts on the same band.
+    """
+
+    def __init__(self, dev, timeout=1.0, snapshot_timeout=5.0, poll_interval=0.002):
+        """
+        :param dev: Serial port of the tinySA, or sim://?rate=200 for a simulated one.
+        :param timeout: Time in seconds a command may wait for the device to answer.
+        :param snapshot_timeout: Time in seconds scanraw waits for the next snapshot.
+        :param poll_interval: Time in seconds between two reads of a port that the event loop cannot watch.
+        """
+        self.dev = dev
+        self.timeout = timeout
+        self.snapshot_timeout = snapshot_timeout
+        self.poll_interval = poll_interval
+        self.serial = None
+        self.fileno = None
+        self.input = bytearray()  # Bytes read from the device and not consumed yet
+        self.settings = {}  # Sweep settings sent to the device, stored in recordings
+        self.commands = asyncio.Queue()
+        self.pending = 0  # Commands queued or waiting for the device
+        self.io_lock = asyncio.Lock()  # Held by the command task or by a running scanraw
+        self.aborted = False
+        self.worker = None
+
+    async def open(self):
+        if self.serial is not None:
+            return
+        if self.dev.startswith(f"{SIMULATOR_SCHEME}://"):
+            self.serial = SimulatedTinySA.from_url(self.dev)
+            self.serial.timeout = 0
+        else:
+            self.serial = serial.Serial(self.dev, timeout=0)
+            try:
+                self.fileno = self.serial.fileno()
+            except (AttributeError, OSError):
+                self.fileno = None  # Not watchable by the event loop, e.g. on Windows
+        self.worker = asyncio.create_task(self._process_commands(), name=f"tinySA {self.dev} commands")
+
+    async def close(self):
+        """
+        Stops the command task and closes the port. Commands that did not get an answer fail with ConnectionError.
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        while not self.commands.empty():
+            _, result, _ = self.commands.get_nowait()
+            if not result.done():
+                result.set_exception(ConnectionError(f"{self.dev} was closed before the command was sent"))
+        self.pending = 0
+        if self.serial:
+            self.serial.close()
+        self.serial = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _wait_readable(self):
+        if self.fileno is None:
+            await asyncio.sleep(self.poll_interval)
+            return
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.fileno, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(self.fileno)
+
+    async def _fill(self):
+        """
+        Waits for bytes from the device and appends them to the input buffer.
+        """
+        while True:
+            data = self.serial.read(max(self.serial.in_waiting, 1))
+            if data:
+                self.input += data
+                return
+            await self._wait_readable()
+
+    async def _readline(self):
+        while (end := self.input.find(b"\n")) < 0:
+            await self._fill()
+        line = bytes(self.input[:end + 1])
+        del self.input[:end + 1]
+        return line
+
+    async def _send(self, command):
+        # Echoed line of the command, like send_command in scan.py. The echo of a command that timed out
+        # can still arrive after the input was reset, lines without this command are skipped.
+        self.serial.write(command.encode())
+        echo = command.strip().encode()
+        while echo not in (line := await self._readline()):
+            pass
+        return line
+
+    async def _process_commands(self):
+        while True:
+            command, result, timeout = await self.commands.get()
+            try:
+                async with self.io_lock:
+                    if not result.cancelled():
+                        try:
+                            result.set_result(await asyncio.wait_for(self._send(command), timeout))
+                        except asyncio.TimeoutError:
+                            # A late echo would be taken for the answer of the next command
+                            self.input.clear()
+                            self.serial.reset_input_buffer()
+                            raise
+            except asyncio.CancelledError:
+                if not result.done():
+                    result.set_exception(ConnectionError(f"{self.dev} was closed before the device answered"))
+                raise
+            except Exception as e:
+                if not result.done():
+                    result.set_exception(e)
+            finally:
+                self.pending -= 1
+
+    async def send_command(self, cmd, timeout=None):
+        """
+        Queues a command and waits until the device has answered.
+
+        :param cmd: Command line ending with '\\r'.
+        :param timeout: Time in seconds the device may take to answer, self.timeout if None.
+        :return: The line echoed by the device.
+        """
+        await self.open()
+        result = asyncio.get_running_loop().create_future()
+        self.pending += 1
+        await self.commands.put((cmd, result, self.timeout if timeout is None else timeout))
+        return await result
+
+    async def sweep(self, mode):
+        await self.send_command(f"sweep {mode}\r")
+        self.settings["sweep"] = mode
+
+    async def spur(self, onof):
+        await self.send_command("spur on\r" if onof else "spur off\r")
+        self.settings["spur"] = bool(onof)
+
+    async def rbw(self, value):
+        await self.send_command(f"rbw {value}\r")
+        self.settings["rbw"] = value
+
+    async def abort(self, command=None):
+        """
+        Sends abort, or abort <command> (e.g. "on" to enable abort). A running scanraw stops.
+        """
+        if not command:
+            self.aborted = True
+        await self.send_command(f"abort {command}\r" if command else "abort\r")
+
+    async def resume(self):
+        await self.send_command("resume\r")
+
+    async def _stop_scan(self):
+        # Called with io_lock held, the commands are sent directly
+        for command in ("abort\r", "resume\r"):
+            self.serial.write(command.encode())
+        await asyncio.sleep(0.01)  # Let the bytes that were already on their way arrive
+        self.serial.reset_input_buffer()
+        self.input.clear()
+
+    async def scanraw(self, start_freq, end_freq, points, timestamps=False, max_snapshots=None):
+        """
+        Runs scanraw and yields the dBm values of every snapshot. Abort must be enabled (abort("on"))
+        so that the scan can be interrupted for other commands.
+        Close the iterator when leaving it early (contextlib.aclosing), so the scan is stopped right away.
+
+        :param timestamps: Yield (time.monotonic_ns(), snapshot) tuples, the time of the read that completed it.
+        :param max_snapshots: Stop after this number of snapshots.
+        :raise TimeoutError: No snapshot arrived within snapshot_timeout seconds.
+        """
+        await self.open()
+        command = f"scanraw {start_freq} {end_freq} {points} 3\r"
+        received = 0
+        # The lock is released while queued commands run, so it is only released at the end if held
+        await self.io_lock.acquire()
+        locked = True
+        scanning = False
+        try:
+            self.aborted = False
+            # Resynchronizing parser: command echoes and partial snapshots around restarts are skipped
+            parser = SnapshotParser(points)
+            scanning = True
+            await asyncio.wait_for(self._send(command), self.timeout)
+            while max_snapshots is None or received < max_snapshots:
+                if self.pending:
+                    await self._stop_scan()
+                    scanning = False
+                    while self.pending:
+                        # asyncio.Lock is fair, the queued commands run before it is acquired again
+                        self.io_lock.release()
+                        locked = False
+                        await asyncio.sleep(0)  # Let the command task take the lock
+                        await self.io_lock.acquire()
+                        locked = True
+                    if self.aborted:
+                        return
+                    parser = SnapshotParser(points)
+                    scanning = True
+                    await asyncio.wait_for(self._send(command), self.timeout)
+                    continue
+
+                try:
+                    await asyncio.wait_for(self._fill(), self.snapshot_timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"No scanraw data from {self.dev} for {self.snapshot_timeout}s") from None
+                arrival = time.monotonic_ns()
+                snapshots = parser.feed(self.input)
+                self.input.clear()
+                for snapshot in snapshots[:None if max_snapshots is None else max_snapshots - received]:
+                    received += 1
+                    yield (arrival, snapshot) if timestamps else snapshot
+        finally:
+            if locked:
+                if scanning and not self.aborted and self.serial is not None:
+                    await self._stop_scan()
+                self.io_lock.release()
+
+async def _demo(devices, start_freq, end_freq, points, seconds):
+    """
+    Scans several devices from one event loop and changes the RBW of each device halfway through.
+    """
+    async def scan(device):
+        await device.abort("on")
+        snapshots = 0
+        started = time.monotonic()
+        rbw_change = None
+        async with contextlib.aclosing(device.scanraw(start_freq, end_freq, points)) as stream:
+            async for _ in stream:
+                snapshots += 1
+                elapsed = time.monotonic() - started
+                if rbw_change is None and elapsed > seconds / 2:
+                    # Interleaved with the running scan from another task
+                    rbw_change = asyncio.create_task(device.rbw(300))
+                if elapsed > seconds:
+                    break
+        if rbw_change is not None:
+            await rbw_change
+        return snapshots, time.monotonic() - started
+
+    clients = [AsyncTinySA(dev) for dev in devices]
+    try:
+        results = await asyncio.gather(*(scan(client) for client in clients))
+        for client, (snapshots, elapsed) in zip(clients, results):
+            print(f"{client.dev}: settings {client.settings}, {snapshots} snapshots in {elapsed:.2f}s ({snapshots / elapsed:.0f} sweeps/s)")
+    finally:
+        for client in clients:
+            await client.close()
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog: [options] [device]...")
+    parser.add_option("-S", "--start", dest="start", type="float", default=865e6, help="start frequency")
+    parser.add_option("-E", "--stop", dest="stop", type="float", default=868e6, help="stop frequency")
+    parser.add_option("-N", "--points", dest="points", type="int", default=25, help="scan points")
+    parser.add_option("-s", "--seconds", dest="seconds", type="float", default=5, help="scan duration")
+    (opt, args) = parser.parse_args()
+
+    asyncio.run(_demo(args or [f"{SIMULATOR_SCHEME}://?rate=200"], opt.start, opt.stop, opt.points, opt.seconds))
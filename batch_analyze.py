@@ -0,0 +1,167 @@
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from recording import CACHE_SUFFIX, COMPRESSED_EXTENSION, RECORDING_EXTENSION
+from hop_duration import read_csv_for_fhss_analysis
+
+# The analyzers import each other by module name
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fhss_analyzers"))
+import average_snaphot_analyzer
+import average_square_analyzer
+import minimization_analyzer
+from utils import calculate_euclidean_distance
+
+def _carrier_columns(result):
+    carriers = result["carriers"]
+    try:
+        distance = calculate_euclidean_distance(carriers)
+    except ValueError:
+        distance = None  # Only defined for the 13 ELRS carriers
+    return {
+        "snapshots": result["snapshots"],
+        "num_carriers": result["num_carriers"],
+        "carriers": " ".join(f"{carrier:.0f}" for carrier in carriers),
+        "euclidean_distance": distance
+    }
+
+def analyze_average(filename, options):
+    return _carrier_columns(average_snaphot_analyzer.analyze(filename, options.get("threshold", -40)))
+
+def analyze_square(filename, options):
+    return _carrier_columns(average_square_analyzer.analyze(filename))
+
+def analyze_minimization(filename, options):
+    result = minimization_analyzer.analyze(filename, options.get("start", 865e6), options.get("end", 870e6))
+    return dict(_carrier_columns(result), f_start=result["f_start"], f_spread=result["f_spread"], cost=result["cost"])
+
+def analyze_hops(filename, options):
+    result = read_csv_for_fhss_analysis(filename, options.get("hop_threshold", -40))
+    columns = {
+        "snapshots": len(result["hops"]) + 1,
+        "hops": len(result["hop_indices"]),
+        "empty_snapshots": result["empty_snapshots"],
+        "scan_period": result["scan_period"],
+        "hop_duration_s": result["hop_duration"] * result["scan_period"]
+    }
+    for percentile, dwell_time in result["dwell_percentiles"].items():
+        columns[f"dwell_p{percentile}_s"] = dwell_time
+    return columns
+
+ANALYZERS = {
+    "average": analyze_average,
+    "square": analyze_square,
+    "minimization": analyze_minimization,
+    "hops": analyze_hops
+}
+
+def find_recordings(patterns):
+    """
+    Expands directories and glob patterns to the recordings, compressed recordings and CSV files to analyze.
+    CSV caches are skipped, and so are the other files of a capture that has a recording: a compressed
+    recording or CSV file with a recording next to it, or a CSV file with a compressed recording.
+
+    :param patterns: Directories, files or glob patterns.
+    :return: Sorted list of file paths.
+    """
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            candidates = [f for extension in (RECORDING_EXTENSION, COMPRESSED_EXTENSION, ".csv")
+                          for f in glob.glob(os.path.join(pattern, "*" + extension))]
+        else:
+            candidates = glob.glob(pattern)
+        files.update(f for f in candidates if os.path.isfile(f) and not f.endswith(CACHE_SUFFIX))
+    # Files of the same capture in order of preference, the first one found is analyzed
+    preferred = (RECORDING_EXTENSION, COMPRESSED_EXTENSION, ".csv")
+
+    def superseded(f):
+        base, extension = os.path.splitext(f)
+        if extension not in preferred:
+            return False
+        return any(base + better in files for better in preferred[:preferred.index(extension)])
+
+    return sorted(f for f in files if not superseded(f))
+
+def run_analysis(analyzer, filename, options):
+    """
+    Runs one analyzer on one file in a worker process.
+
+    :return: Row of the results table, with the error message if the analysis failed.
+    """
+    row = {"file": filename, "analyzer": analyzer}
+    started = time.perf_counter()
+    try:
+        row.update(ANALYZERS[analyzer](filename, options))
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["seconds"] = time.perf_counter() - started
+    return row
+
+def batch_analyze(files, analyzers, output_file, processes=None, **options):
+    """
+    Runs the chosen analyzers over the files on a process pool and writes one consolidated CSV table.
+
+    :param files: Paths to .rec or .crec recordings or CSV files.
+    :param analyzers: Names from ANALYZERS.
+    :param output_file: Path to the results CSV file.
+    :param processes: Number of worker processes, the number of CPUs if None.
+    :param options: Analyzer settings: threshold, hop_threshold, start and end.
+    :return: List of result rows in file and analyzer order.
+    """
+    tasks = [(analyzer, filename) for filename in files for analyzer in analyzers]
+    rows = {}
+    with ProcessPoolExecutor(processes) as executor:
+        futures = {executor.submit(run_analysis, analyzer, filename, options): (analyzer, filename)
+                   for analyzer, filename in tasks}
+        for future in as_completed(futures):
+            row = future.result()
+            rows[futures[future]] = row
+            status = row["error"] if "error" in row else f"{row['seconds']:.2f} s"
+            print(f"[{len(rows)}/{len(tasks)}] {row['analyzer']} {row['file']}: {status}")
+
+    rows = [rows[task] for task in tasks]
+    fieldnames = []
+    for row in rows:
+        fieldnames += [name for name in row if name not in fieldnames]
+    # Timing and errors after the results of all analyzers
+    fieldnames = [name for name in fieldnames if name not in ("seconds", "error")] + \
+                 [name for name in ("seconds", "error") if name in fieldnames]
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog: [options] <directory, file or glob>...")
+    parser.add_option("-a", "--analyzers", dest="analyzers", default=",".join(ANALYZERS),
+                      help=f"comma separated analyzers to run ({', '.join(ANALYZERS)})", metavar="ANALYZERS")
+    parser.add_option("-o", "--output", dest="output", default="analysis_results.csv",
+                      help="results CSV file", metavar="FILE")
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=None,
+                      help="number of worker processes (number of CPUs by default)", metavar="PROCESSES")
+    parser.add_option("-t", "--threshold", dest="threshold", type="float", default=-40,
+                      help="dBm threshold for averaging in the average analyzer", metavar="THRESHOLD")
+    parser.add_option("--hop-threshold", dest="hop_threshold", type="float", default=-40,
+                      help="dBm threshold to detect carriers in the hop analysis", metavar="THRESHOLD")
+    parser.add_option("-S", "--start", dest="start", type="float", default=865e6,
+                      help="lowest carrier frequency of the minimization fit", metavar="START")
+    parser.add_option("-E", "--end", dest="end", type="float", default=870e6,
+                      help="highest frequency of the minimization fit", metavar="END")
+    (opt, args) = parser.parse_args()
+
+    analyzers = opt.analyzers.split(",")
+    unknown = [analyzer for analyzer in analyzers if analyzer not in ANALYZERS]
+    if unknown or not args:
+        parser.error(f"unknown analyzers {unknown}" if unknown else "no recordings given")
+
+    files = find_recordings(args)
+    print(f"Analyzing {len(files)} files with {', '.join(analyzers)}")
+    batch_analyze(files, analyzers, opt.output, opt.processes, threshold=opt.threshold,
+                  hop_threshold=opt.hop_threshold, start=opt.start, end=opt.end)
+    print(f"Results written to {opt.output}")
@@ -0,0 +1,192 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from bin_to_csv import bin_to_csv, bin_to_recording, read_binary_file
+from hop_duration import analyze_hops, occupancy_matrix
+from recording import CACHE_SUFFIX, load_csv_cached, open_recording
+from simulator import SimulatedTinySA
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fhss_analyzers"))
+from average_snaphot_analyzer import StreamingAverager, find_carriers
+from average_square_analyzer import StreamingSquareAverager, find_carriers as find_square_carriers
+from minimization_analyzer import grid_search
+from utils import iterate_batches
+
+START_FREQ = 865e6
+STOP_FREQ = 870e6
+SCAN_PERIOD = 0.005
+# dBm threshold of the carriers, which the simulator sends at -40 dBm over a -110 dBm noise floor
+CARRIER_THRESHOLD = -60
+
+def write_synthetic_capture(filename, count, points, chunk_size=65536):
+    """
+    Writes a scanraw capture of `count` simulated FHSS snapshots, like save_signal_data would.
+
+    :return: Array of the frequency of every point.
+    """
+    simulator = SimulatedTinySA(rate=1 / SCAN_PERIOD, carriers=13, hop_interval=0.02)
+    frequencies = np.linspace(START_FREQ, STOP_FREQ, points)
+    with open(filename, "wb") as f:
+        for first in range(0, count, chunk_size):
+            f.write(simulator.frames(frequencies, first, min(chunk_size, count - first)).data)
+    return frequencies
+
+def measure(function, repeat=1, memory=True):
+    """
+    Times a stage and records the peak memory it allocates (NumPy arrays included).
+    The time is the best of `repeat` untraced runs; the memory comes from one more run under tracemalloc.
+
+    :return: A tuple of (result, seconds, peak memory in bytes or None).
+    """
+    seconds = np.inf
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        seconds = min(seconds, time.perf_counter() - started)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                function()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+def average(snapshots, accumulator):
+    for batch in iterate_batches(snapshots):
+        accumulator.update(batch)
+    return accumulator.average()
+
+def run_case(directory, count, points, repeat=1, memory=True, csv_cells=2e7):
+    """
+    Runs every stage on a synthetic capture of `count` snapshots of `points` points.
+
+    :param csv_cells: Largest snapshots x points for which the CSV stages are run.
+    :return: List of result dictionaries, one per stage.
+    """
+    capture = os.path.join(directory, f"capture_{count}_{points}.bin")
+    recording = capture[:-4] + ".rec"
+    csv_file = capture[:-4] + ".csv"
+    frequencies = write_synthetic_capture(capture, count, points)
+    results = []
+
+    def stage(name, function):
+        result, seconds, peak = measure(function, repeat, memory)
+        results.append({"stage": name, "snapshots": count, "points": points, "seconds": seconds,
+                        "snapshots_per_second": count / seconds if seconds else None, "peak_memory_bytes": peak})
+        print(f"{name:>20} {count:>9} x {points:<5} {seconds:10.4f} s"
+              + (f" {peak / 2 ** 20:10.1f} MiB" if peak is not None else ""))
+        return result
+
+    stage("frame_parsing", lambda: sum(len(block) for block in read_binary_file(capture, points, 4096)))
+    stage("bin_to_recording", lambda: bin_to_recording(capture, recording, points, START_FREQ, STOP_FREQ, 0))
+    if count * points <= csv_cells:
+        stage("bin_to_csv", lambda: bin_to_csv(capture, csv_file, points, START_FREQ, STOP_FREQ, 0))
+
+        def load_csv_cold():
+            if os.path.exists(csv_file + CACHE_SUFFIX):
+                os.remove(csv_file + CACHE_SUFFIX)
+            return float(np.sum(load_csv_cached(csv_file)[1]))
+        stage("csv_load_cold", load_csv_cold)
+        stage("csv_load_cached", lambda: float(np.sum(load_csv_cached(csv_file)[1])))
+    stage("recording_load", lambda: float(np.sum(open_recording(recording)[2])))
+
+    snapshots = open_recording(recording)[2]
+    averaged = stage("averaging", lambda: average(snapshots, StreamingAverager(points, CARRIER_THRESHOLD)))
+    stage("find_carriers", lambda: find_carriers(frequencies, averaged.copy(), CARRIER_THRESHOLD))
+    squared = stage("square_averaging", lambda: average(snapshots, StreamingSquareAverager(points)))
+    num_carriers = max(len(find_square_carriers(frequencies, squared)), 1)
+    stage("minimization_fit", lambda: grid_search(num_carriers, squared, frequencies, [START_FREQ, STOP_FREQ]))
+    stage("hop_detection", lambda: analyze_hops(occupancy_matrix(snapshots, CARRIER_THRESHOLD), SCAN_PERIOD))
+
+    del snapshots
+    for filename in os.listdir(directory):
+        os.remove(os.path.join(directory, filename))
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a baseline run and prints the stages that got slower than baseline * tolerance.
+
+    :return: Number of regressions.
+    """
+    previous = {(r["stage"], r["snapshots"], r["points"]): r for r in baseline["results"]}
+    regressions = 0
+    for result in results:
+        old = previous.get((result["stage"], result["snapshots"], result["points"]))
+        if old is None or not old["seconds"]:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        if ratio > tolerance:
+            regressions += 1
+            print(f"REGRESSION {result['stage']} {result['snapshots']} x {result['points']}: "
+                  f"{old['seconds']:.4f} s -> {result['seconds']:.4f} s ({ratio:.2f}x)")
+    print(f"{regressions} regressions compared with the baseline (tolerance {tolerance}x)")
+    return regressions
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog: [options]")
+    parser.add_option("-n", "--snapshots", dest="snapshots", default="1e3,1e4,1e5,1e6",
+                      help="comma separated snapshot counts", metavar="COUNTS")
+    parser.add_option("-p", "--points", dest="points", default="25,200,1000",
+                      help="comma separated numbers of points", metavar="POINTS")
+    parser.add_option("-m", "--max-cells", dest="max_cells", type="float", default=1e8,
+                      help="skip cases with more snapshots x points", metavar="CELLS")
+    parser.add_option("-c", "--csv-cells", dest="csv_cells", type="float", default=2e7,
+                      help="run the CSV stages up to this many snapshots x points", metavar="CELLS")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=1,
+                      help="timed runs per stage, the best one is kept", metavar="REPEAT")
+    parser.add_option("--no-memory", dest="memory", action="store_false", default=True,
+                      help="do not measure peak memory")
+    parser.add_option("-o", "--output", dest="output", help="write the results to a JSON file", metavar="FILE")
+    parser.add_option("-b", "--baseline", dest="baseline", help="compare with the JSON results of an earlier run",
+                      metavar="FILE")
+    parser.add_option("-t", "--tolerance", dest="tolerance", type="float", default=1.2,
+                      help="slowdown reported as a regression", metavar="RATIO")
+    parser.add_option("-d", "--directory", dest="directory", help="directory for the synthetic files",
+                      metavar="DIR")
+    (opt, args) = parser.parse_args()
+
+    results = []
+    skipped = []
+    with tempfile.TemporaryDirectory(dir=opt.directory) as directory:
+        for points in [int(p) for p in opt.points.split(",")]:
+            for count in [int(float(n)) for n in opt.snapshots.split(",")]:
+                if count * points > opt.max_cells:
+                    print(f"Skipping {count} x {points}, more than {opt.max_cells:.0f} cells")
+                    skipped.append({"snapshots": count, "points": points})
+                    continue
+                results += run_case(directory, count, points, opt.repeat, opt.memory, opt.csv_cells)
+    if skipped:
+        # Repeated at the end, the messages above scroll away during long runs
+        cases = ", ".join(f"{case['snapshots']} x {case['points']}" for case in skipped)
+        print(f"Skipped the cases with more than -m {opt.max_cells:.0f} snapshots x points "
+              f"(a capture of {3 * opt.max_cells / 1e9:.1f} GB or more each): {cases}. Raise -m to run them.")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "processor": platform.processor(),
+                        "cpus": os.cpu_count()},
+        "results": results,
+        "skipped": skipped
+    }
+    if opt.output:
+        with open(opt.output, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Results written to {opt.output}")
+    if opt.baseline:
+        with open(opt.baseline) as f:
+            sys.exit(1 if compare(results, json.load(f), opt.tolerance) else 0)
@@ -1,23 +1,198 @@
 import sys
 import os
-import struct
 import csv
 import numpy as np
 import logging
+import time
+from recording import CODE_DBM_OFFSET, CODES_PER_DB, RecordingWriter, read_timestamps
 
 # Set up logging
 logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
 
-def read_binary_file(input_file, snapshot_size, buffer_size):
+# Markers of the scanraw output: each snapshot is '{', `points` blocks of 'x' LSB MSB, then '}'
+SNAPSHOT_START = ord('{')
+SNAPSHOT_END = ord('}')
+POINT_MARKER = ord('x')
+
+def snapshot_dtype(points):
+    """
+    Builds a NumPy structured dtype describing one scanraw snapshot.
+    
+    :param points: Number of points in each scan.
+    :return: A packed dtype of points * 3 + 2 bytes ('{', points * ('x', int16), '}').
+    """
+    point = np.dtype([('marker', 'u1'), ('value', '<i2')])
+    return np.dtype([('start', 'u1'), ('points', point, (points,)), ('end', 'u1')])
+
+def codes_to_dbm(codes):
+    """
+    Converts raw scanraw values to dBm (TinySA Ultra adjustment).
+    
+    :param codes: Array of raw 16-bit signed values.
+    :return: Array of float64 dBm values.
+    """
+    return codes.astype(np.float64) / CODES_PER_DB + CODE_DBM_OFFSET
+
+def decode_snapshots(data, points, timestamps=None):
+    """
+    Decodes a block of whole snapshots to dBm values in one pass.
+    Snapshots with a missing '{', '}' or 'x' marker are discarded.
+    
+    :param data: Bytes-like object holding consecutive snapshots.
+    :param points: Number of points in each scan.
+    :param timestamps: Optional arrival time of every snapshot of data, filtered like the snapshots.
+    :return: Array of dBm values, one row per valid snapshot,
+             or a tuple of (timestamps, snapshots) of the valid snapshots when timestamps are given.
+    """
+    dtype = snapshot_dtype(points)
+    frames = np.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize)
+    valid = ((frames['start'] == SNAPSHOT_START) & (frames['end'] == SNAPSHOT_END) &
+             np.all(frames['points']['marker'] == POINT_MARKER, axis=1))
+
+    corrupted = len(frames) - np.count_nonzero(valid)
+    if corrupted:
+        logging.warning(f"{corrupted} corrupted or incomplete snapshots found. Discarding them.")
+
+    snapshots = codes_to_dbm(frames['points']['value'][valid])
+    if timestamps is not None:
+        return np.asarray(timestamps)[:len(frames)][valid], snapshots
+    return snapshots
+
+def find_snapshots(data, points):
     """
-    Generator function to read binary data from a file in chunks and yield snapshots one by one.
+    Finds the start offsets of valid snapshots in a byte stream, wherever they are.
+    A valid snapshot is a '{' followed by `points` 'x'-framed values and a '}'.
+    Runs in O(n): the number of consecutive 'x' markers at a stride of 3 is computed for every offset.
+    
+    :param data: Bytes-like object holding the stream.
+    :param points: Number of points in each scan.
+    :return: Sorted array of non-overlapping snapshot start offsets.
+    """
+    snapshot_size = points * 3 + 2
+    stream = np.frombuffer(data, dtype=np.uint8)
+    length = len(stream)
+    if length < snapshot_size:
+        return np.empty(0, dtype=np.intp)
+
+    # x_run[i] is the number of 'x' markers found at i, i + 3, i + 6, ... before the first other byte
+    is_marker = stream == POINT_MARKER
+    x_run = np.empty(length, dtype=np.intp)
+    for residue in range(3):
+        markers = is_marker[residue::3]
+        index = np.arange(len(markers))
+        next_other = np.where(markers, len(markers), index)
+        next_other = np.minimum.accumulate(next_other[::-1])[::-1]
+        x_run[residue::3] = next_other - index
+
+    starts = np.flatnonzero(stream[:length - snapshot_size + 1] == SNAPSHOT_START)
+    starts = starts[(stream[starts + snapshot_size - 1] == SNAPSHOT_END) & (x_run[starts + 1] >= points)]
+
+    # A '{' inside a valid snapshot may look like a snapshot start too, keep the first one
+    if np.all(np.diff(starts) >= snapshot_size):
+        return starts
+    accepted = []
+    next_free = 0
+    for start in starts.tolist():
+        if start >= next_free:
+            accepted.append(start)
+            next_free = start + snapshot_size
+    return np.array(accepted, dtype=np.intp)
+
+class SnapshotParser:
+    """
+    Streaming scanraw parser that resynchronizes on the next valid snapshot after dropped,
+    extra or corrupted bytes, instead of relying on fixed snapshot offsets.
+    Bytes that do not belong to a valid snapshot are counted in `skipped`, and the runs of them in `resyncs`.
+    The stream offsets of the snapshots returned by the last feed() are kept in `starts`.
+    """
+
+    def __init__(self, points, codes=False):
+        """
+        :param points: Number of points expected in each scan.
+        :param codes: Return the raw int16 values instead of dBm values.
+        """
+        self.points = points
+        self.codes = codes
+        self.snapshot_size = points * 3 + 2
+        self.dtype = snapshot_dtype(points)
+        self.pending = b''
+        self.skipped = 0
+        self.resyncs = 0
+        self.in_gap = False  # The last feed() ended with skipped bytes, a gap that the next one may continue
+        self.snapshots = 0
+        self.offset = 0  # Stream offset of the first pending byte
+        self.starts = np.empty(0, dtype=np.intp)
+
+    def feed(self, data):
+        """
+        Parses the next piece of the stream. An incomplete snapshot at the end is kept for the next call.
+        
+        :param data: Bytes-like object with the next bytes of the stream.
+        :return: Array of dBm values (or raw values), one row per valid snapshot.
+        """
+        pending = self.pending + bytes(data)
+        stream = np.frombuffer(pending, dtype=np.uint8)
+        starts = find_snapshots(pending, self.points)
+
+        consumed = starts[-1] + self.snapshot_size if len(starts) else 0
+        # Keep the bytes from the first '{' that may still start a snapshot once more data arrives
+        tail_start = max(consumed, len(pending) - self.snapshot_size + 1)
+        openings = np.flatnonzero(stream[tail_start:] == SNAPSHOT_START)
+        keep_from = tail_start + openings[0] if len(openings) else len(pending)
+
+        self.skipped += int(keep_from) - len(starts) * self.snapshot_size
+        # Skipped runs before the first snapshot, between snapshots and after the last one
+        gap_starts = np.concatenate(([0], starts + self.snapshot_size))
+        gap_ends = np.append(starts, keep_from)
+        gaps = gap_ends > gap_starts
+        # A gap at the start continues the one the last call ended with, it is only counted once
+        self.resyncs += int(np.count_nonzero(gaps)) - int(self.in_gap and gaps[0])
+        self.in_gap = bool(gaps[-1]) if len(starts) else self.in_gap or bool(gaps[0])
+        self.snapshots += len(starts)
+        self.starts = starts + self.offset
+        self.offset += int(keep_from)
+        self.pending = pending[keep_from:]
+
+        if len(starts) and starts[-1] - starts[0] == (len(starts) - 1) * self.snapshot_size:
+            # Consecutive snapshots, view them in place
+            frames = np.frombuffer(pending, dtype=self.dtype, count=len(starts), offset=int(starts[0]))
+        else:
+            frames = stream[starts[:, None] + np.arange(self.snapshot_size)].view(self.dtype)[:, 0]
+        if self.codes:
+            return frames['points']['value'].astype(np.int16)
+        return codes_to_dbm(frames['points']['value'])
+
+    def closing_slots(self):
+        """
+        Returns the fixed-size snapshot slot of the stream (offset // snapshot_size) holding the closing '}'
+        of every snapshot returned by the last feed(). The capture stores one arrival time per slot,
+        so after dropped bytes a snapshot gets the time of the slot it was completed in.
+        """
+        return (self.starts + self.snapshot_size - 1) // self.snapshot_size
+
+    def finish(self):
+        """
+        Marks the end of the stream. Bytes of an incomplete last snapshot are counted as skipped.
+        """
+        self.skipped += len(self.pending)
+        self.resyncs += int(bool(self.pending) and not self.in_gap)
+        self.pending = b''
+        self.in_gap = False
+
+def read_binary_file(input_file, points, buffer_size, parser=None, metrics=None):
+    """
+    Generator function to read binary data from a file in chunks and yield decoded snapshots block by block.
+    The stream is resynchronized on the next valid snapshot after corrupted or misaligned data.
     
     :param input_file: Path to the binary data file.
-    :param snapshot_size: Size of one snapshot in bytes (including '{' and '}').
+    :param points: Number of points expected in each scan.
     :param buffer_size: Number of snapshots to process in one buffer.
-    :return: Yields individual snapshots from the binary file.
+    :param parser: Optional SnapshotParser, to inspect the skipped byte count afterwards.
+    :param metrics: Optional metrics.Metrics counting the converted bytes, snapshots and malformed frames.
+    :return: Yields arrays of dBm values, one row per snapshot.
     """
-    buffer_byte_size = snapshot_size * buffer_size  # Size of the buffer in bytes
+    parser = parser or SnapshotParser(points)
+    buffer_byte_size = parser.snapshot_size * buffer_size  # Size of the buffer in bytes
 
     with open(input_file, 'rb') as infile:
         while True:
@@ -26,24 +201,24 @@ def read_binary_file(input_file, snapshot_size, buffer_size):
             if not buffer_data:
                 break  # No more data to read
 
-            # Ensure that the data read has complete snapshots
-            if len(buffer_data) % snapshot_size != 0:
-                logging.warning("Last snapshot in the buffer is incomplete. Discarding it.")
-                buffer_data = buffer_data[:-(len(buffer_data) % snapshot_size)]
+            started = time.perf_counter()
+            skipped, resyncs = parser.skipped, parser.resyncs
+            snapshots = parser.feed(buffer_data)
+            if metrics is not None:
+                metrics.observe("converter_parse_seconds", time.perf_counter() - started)
+                metrics.inc("converter_bytes_total", len(buffer_data))
+                metrics.inc("converter_snapshots_total", len(snapshots))
+                metrics.inc("converter_skipped_bytes_total", parser.skipped - skipped)
+                metrics.inc("converter_malformed_frames_total", parser.resyncs - resyncs)
+            if len(snapshots):
+                yield snapshots
 
-            # Process each snapshot in the buffer
-            for snapshot_start in range(0, len(buffer_data), snapshot_size):
-                snapshot_data = buffer_data[snapshot_start:snapshot_start + snapshot_size]
+    parser.finish()
+    if parser.skipped:
+        logging.warning(f"Skipped {parser.skipped} bytes of corrupted or incomplete data.")
 
-                # Ensure the snapshot starts with '{' and ends with '}'
-                if snapshot_data[0] != ord('{') or snapshot_data[-1] != ord('}'):
-                    logging.warning("Corrupted or incomplete snapshot found. Discarding it.")
-                    continue
 
-                yield snapshot_data
-
-
-def bin_to_csv(input_file, output_file, points, start_freq, stop_freq, scan_duration, buffer_size=10):
+def bin_to_csv(input_file, output_file, points, start_freq, stop_freq, scan_duration, buffer_size=4096, metrics=None):
     """
     Parse binary data from a file and convert it to CSV, handling snapshots surrounded by {}.
     
@@ -53,15 +228,13 @@ def bin_to_csv(input_file, output_file, points, start_freq, stop_freq, scan_dura
     :param start_freq: Start frequency in Hz.
     :param stop_freq: Stop frequency in Hz.
     :param buffer_size: Number of snapshots to read from file in one buffer.
+    :param metrics: Optional metrics.Metrics for the conversion.
     :return: None
     """
     
     # Calculate frequencies
     frequencies = np.linspace(start_freq, stop_freq, points)
     
-    # Each point consists of 'x' followed by 2 bytes (LSB and MSB), so each block is 3 bytes long
-    snapshot_size = points * 3 + 2  # Size of one snapshot in bytes (including '{' and '}')
-
     with open(output_file, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
 
@@ -70,38 +243,51 @@ def bin_to_csv(input_file, output_file, points, start_freq, stop_freq, scan_dura
         writer.writerow(header)
 
         snapshot_count = 0
+        parser = SnapshotParser(points)
 
-        # Use the generator to read the binary file, yielding each snapshot
-        for snapshot_data in read_binary_file(input_file, snapshot_size, buffer_size):
-            snapshot_data = snapshot_data[1:-1]  # Remove the surrounding braces '{}'
-            snapshot_values = []
-
-            for i in range(points):
-                # Each point has the format: 'x' LSB MSB
-                x_char = snapshot_data[3 * i]  # This should be 'x'
-                lsb = snapshot_data[3 * i + 1]
-                msb = snapshot_data[3 * i + 2]
-
-                # Validate that the 'x' character is present
-                if chr(x_char) != 'x':
-                    logging.warning(f"Expected 'x' character at position {3 * i}, but got {chr(x_char)}. Discarding snapshot.")
-                    snapshot_values = None
-                    break
+        # Use the generator to read the binary file, yielding decoded blocks of snapshots
+        for snapshots in read_binary_file(input_file, points, buffer_size, parser, metrics):
+            rows = []
+            for snapshot_values in snapshots.tolist():
+                snapshot_count += 1
+                rows.append([f"Sweep {snapshot_count}"] + snapshot_values)
+            # Write the snapshot dBm values to the CSV file
+            writer.writerows(rows)
 
-                # Combine LSB and MSB to form a 16-bit signed value (little-endian)
-                value = struct.unpack("<h", bytes([lsb, msb]))[0]
+    scan_time = scan_duration / snapshot_count
+    print(f"CSV file written to {output_file} with {snapshot_count} snapshots. scan_time={scan_time}ms skipped_bytes={parser.skipped}")
 
-                # Convert the value to dBm (TinySA Ultra adjustment)
-                dBm = (value / 32.0) - 174
-                snapshot_values.append(dBm)
 
-            if snapshot_values:
-                snapshot_count += 1
-                # Write the snapshot dBm values to the CSV file
-                writer.writerow([f"Sweep {snapshot_count}"] + snapshot_values)
+def bin_to_recording(input_file, output_file, points, start_freq, stop_freq, scan_duration, buffer_size=4096, metrics=None,
+                     **settings):
+    """
+    Parse binary data from a file and convert it to a recording that the analyzers can memory-map.
+    The raw int16 values are stored, open_recording converts them to dBm when they are read.
+    
+    :param input_file: Path to the binary data file.
+    :param output_file: Path to the output recording file.
+    :param points: Number of points expected in each scan.
+    :param start_freq: Start frequency in Hz.
+    :param stop_freq: Stop frequency in Hz.
+    :param scan_duration: Duration of the capture in ms.
+    :param buffer_size: Number of snapshots to read from file in one buffer.
+    :param metrics: Optional metrics.Metrics for the conversion.
+    :param settings: Sweep settings (sweep mode, rbw, spur) stored in the recording header.
+    :return: None
+    """
+    parser = SnapshotParser(points, codes=True)
+    # The capture engine stores one arrival time per snapshot slot of the binary file
+    arrivals = read_timestamps(input_file)
+    with RecordingWriter(output_file, start_freq, stop_freq, points, dtype=np.int16, codes=True,
+                         **settings) as recording:
+        for snapshots in read_binary_file(input_file, points, buffer_size, parser, metrics):
+            timestamps = None
+            if arrivals is not None and len(arrivals):
+                timestamps = arrivals[np.minimum(parser.closing_slots(), len(arrivals) - 1)]
+            recording.write(snapshots, timestamps)
+        recording.close(capture_duration_ms=scan_duration, skipped_bytes=parser.skipped)
 
-    scan_time = scan_duration / snapshot_count
-    print(f"CSV file written to {output_file} with {snapshot_count} snapshots. scan_time={scan_time}ms")
+    print(f"Recording written to {output_file} with {recording.snapshots} snapshots.")
 
 
 if __name__ == "__main__":
@@ -115,6 +301,7 @@ if __name__ == "__main__":
     points = int(sys.argv[2])
     start_freq = float(sys.argv[3])
     stop_freq = float(sys.argv[4])
-    buffer_size = int(sys.argv[5]) if len(sys.argv) == 6 else 10  # Default buffer_size to 10 if not provided
+    buffer_size = int(sys.argv[5]) if len(sys.argv) == 6 else 4096  # Default buffer_size to 4096 if not provided
 
-    bin_to_csv(input_file, output_file, points, start_freq, stop_freq, buffer_size)
+    bin_to_csv(input_file, output_file, points, start_freq, stop_freq, 0, buffer_size)
+    bin_to_recording(input_file, os.path.join("recordings", f"{filename}.rec"), points, start_freq, stop_freq, 0, buffer_size)
@@ -0,0 +1,271 @@
+import contextlib
+import threading
+import time
+import numpy as np
+from recording import TIMESTAMPS_SUFFIX
+
+class SnapshotRing:
+    """
+    Bounded ring buffer of fixed-size snapshots shared by one producer and one consumer thread.
+    All slots are preallocated, so pushing a snapshot never allocates memory.
+    Each slot also holds the arrival time of its snapshot in a parallel int64 array.
+    """
+
+    def __init__(self, snapshot_size, capacity):
+        """
+        :param snapshot_size: Size of one snapshot in bytes (including '{' and '}').
+        :param capacity: Maximum number of snapshots held by the ring.
+        """
+        self.snapshot_size = snapshot_size
+        self.capacity = capacity
+        self.buffer = bytearray(snapshot_size * capacity)
+        self.view = memoryview(self.buffer)
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.head = 0  # Next slot to be written by the producer
+        self.tail = 0  # Next slot to be read by the consumer
+        self.count = 0
+        self.closed = False
+        self.overruns = 0
+        self.high_water = 0
+        self.condition = threading.Condition()
+
+    def put(self, snapshot, timestamp=0):
+        """
+        Copies a snapshot into the next free slot. Never blocks: if the ring is full the snapshot is dropped.
+
+        :param snapshot: Bytes-like object of snapshot_size bytes.
+        :param timestamp: Arrival time of the snapshot in time.monotonic_ns() nanoseconds.
+        :return: True if the snapshot was stored, False if it was dropped.
+        """
+        with self.condition:
+            if self.count == self.capacity:
+                self.overruns += 1
+                return False
+            slot = self.head
+
+        # Only the producer writes to a free slot, so the copy does not need the lock
+        start = slot * self.snapshot_size
+        self.view[start:start + self.snapshot_size] = snapshot
+        self.times[slot] = timestamp
+
+        with self.condition:
+            self.head = (slot + 1) % self.capacity
+            self.count += 1
+            self.high_water = max(self.high_water, self.count)
+            self.condition.notify()
+        return True
+
+    def get(self, timeout=None):
+        """
+        Waits for snapshots and returns the longest contiguous run of them without copying.
+        The run stays valid until release() is called.
+
+        :param timeout: Maximum time in seconds to wait for a snapshot.
+        :return: A memoryview of whole snapshots, empty if the ring is closed and drained or the wait timed out.
+        """
+        with self.condition:
+            if not self.count and not self.closed:
+                self.condition.wait(timeout)
+            count = min(self.count, self.capacity - self.tail)
+            start = self.tail * self.snapshot_size
+        return self.view[start:start + count * self.snapshot_size]
+
+    def timestamps(self, snapshots):
+        """
+        Returns the arrival times of the snapshots returned by the last get(), valid until release().
+
+        :param snapshots: The memoryview returned by get().
+        """
+        return self.times[self.tail:self.tail + len(snapshots) // self.snapshot_size]
+
+    def release(self, snapshots):
+        """
+        Frees the slots returned by the last get().
+
+        :param snapshots: The memoryview returned by get().
+        """
+        count = len(snapshots) // self.snapshot_size
+        with self.condition:
+            self.tail = (self.tail + count) % self.capacity
+            self.count -= count
+
+    def close(self):
+        """
+        Marks the end of the stream and wakes up the consumer.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def drained(self):
+        with self.condition:
+            return self.closed and not self.count
+
+class CaptureEngine:
+    """
+    Captures scanraw snapshots with a dedicated serial reader thread and a disk writer thread.
+    The reader only copies snapshots into a SnapshotRing, so the device is drained at full rate
+    even when the writer stalls. Snapshots that do not fit into the ring are counted as overruns.
+    The arrival time of every snapshot is saved next to the file (filename + TIMESTAMPS_SUFFIX).
+    With a compressor, the snapshots and their arrival times go to a compressed recording instead.
+    """
+
+    def __init__(self, device, filename, start_freq, end_freq, points, capacity=4096, buffer_size=65536, sinks=(),
+                 metrics=None, compressor=None):
+        """
+        :param device: An opened or openable tinySA instance.
+        :param filename: The name of the file to save the signal data.
+        :param capacity: Number of snapshots the ring buffer can hold.
+        :param buffer_size: The size of the buffer (in bytes) for writing to the file.
+        :param sinks: Callables receiving each written batch of raw snapshots and the arrival time of every
+                      snapshot (a memoryview and an int64 array that are only valid during the call).
+                      They run on the writer thread and must not block.
+        :param metrics: Optional metrics.Metrics. The reader records the serial reads (see scanraw_snapshots)
+                        and the overruns, the writer the file writes, the ring backlog and the sweep intervals.
+        :param compressor: Optional compressed_recording.CaptureCompressor written on the writer thread
+                           instead of the binary file, which is then not created. The caller closes it.
+        """
+        self.device = device
+        self.filename = filename
+        self.start_freq = start_freq
+        self.end_freq = end_freq
+        self.points = points
+        self.buffer_size = buffer_size
+        self.sinks = list(sinks)
+        self.metrics = metrics
+        self.compressor = compressor
+        self.ring = SnapshotRing(points * 3 + 2, capacity)
+        self.stop_event = threading.Event()
+        self.reader_done = threading.Event()
+        self.snapshots_read = 0
+        self.snapshots_written = 0
+        self.reader = threading.Thread(target=self._read, name="tinySA reader", daemon=True)
+        self.writer = threading.Thread(target=self._write, name="tinySA writer", daemon=True)
+
+    def _read(self):
+        try:
+            for timestamp, snapshot in self.device.scanraw_snapshots(self.start_freq, self.end_freq, self.points,
+                                                                     mode="view", timestamps=True,
+                                                                     metrics=self.metrics):
+                self.snapshots_read += 1
+                if not self.ring.put(snapshot, timestamp) and self.metrics is not None:
+                    self.metrics.inc("ring_overruns_total")
+                if self.stop_event.is_set():
+                    break
+        finally:
+            self.ring.close()
+            self.reader_done.set()
+
+    def _write(self):
+        # Arrival times are stored in a parallel int64 file, one value per snapshot
+        last_timestamp = None
+        with contextlib.ExitStack() as files:
+            if self.compressor is None:
+                f = files.enter_context(open(self.filename, "wb", buffering=self.buffer_size))
+                times = files.enter_context(open(self.filename + TIMESTAMPS_SUFFIX, "wb"))
+            while not self.ring.drained():
+                snapshots = self.ring.get(timeout=0.5)
+                if snapshots:
+                    write_started = time.perf_counter()
+                    timestamps = self.ring.timestamps(snapshots)
+                    if self.compressor is None:
+                        f.write(snapshots)
+                        times.write(timestamps.astype("<i8").data)
+                    else:
+                        self.compressor.write(snapshots, timestamps)
+                    if self.metrics is not None:
+                        self._record_write(snapshots, timestamps, last_timestamp, time.perf_counter() - write_started)
+                        last_timestamp = int(timestamps[-1])
+                    for sink in self.sinks:
+                        sink(snapshots, timestamps)
+                    self.snapshots_written += len(snapshots) // self.ring.snapshot_size
+                    self.ring.release(snapshots)
+
+    def _record_write(self, snapshots, timestamps, last_timestamp, seconds):
+        metrics = self.metrics
+        metrics.observe("file_write_seconds", seconds)
+        metrics.inc("bytes_written_total", len(snapshots))
+        metrics.inc("snapshots_written_total", len(timestamps))
+        # Snapshots still waiting in the ring, this batch included
+        metrics.set("writer_backlog_snapshots", self.ring.count)
+        metrics.set("ring_high_water_snapshots", self.ring.high_water)
+        # Time between sweeps as seen by the host, which includes the device-side sweep time
+        intervals = np.diff(timestamps, prepend=timestamps[0] if last_timestamp is None else last_timestamp)
+        metrics.histogram("sweep_interval_seconds").observe_many(intervals[last_timestamp is None:] / 1e9)
+
+    def start(self):
+        self.writer.start()
+        self.reader.start()
+
+    def stop(self):
+        """
+        Stops the reader, aborts the scanraw command and waits until the writer has flushed the ring.
+        """
+        self.stop_event.set()
+        while not self.reader_done.is_set():
+            if self.device.serial is not None:
+                self.device.serial.cancel_read()  # Unblock a pending serial read
+            self.reader_done.wait(0.1)
+        self.reader.join()
+        self.device.abort()
+        self.device.resume()
+        self.writer.join()
+
+    def run(self, idle=None):
+        """
+        Captures until the device stops sending data or the user presses Ctrl+C.
+
+        :param idle: Optional callable run repeatedly on the calling thread while capturing,
+                     e.g. LiveSpectrumView.render. It must return quickly.
+        """
+        self.start()
+        try:
+            # Waiting on an event rather than join() keeps the thread state intact on Ctrl+C
+            while not self.reader_done.wait(0.2 if idle is None else 0.005):
+                if idle is not None:
+                    idle()
+        except KeyboardInterrupt:
+            print("Data reading interrupted by user.")
+        self.stop()
+
+    def stats(self):
+        return {
+            "snapshots_read": self.snapshots_read,
+            "snapshots_written": self.snapshots_written,
+            "overruns": self.ring.overruns,
+            "high_water": self.ring.high_water,
+            "capacity": self.ring.capacity,
+        }
+
+class MultiCapture:
+    """
+    Runs one CaptureEngine per device at the same time, e.g. several tinySA units covering different bands.
+    All engines take their timestamps from time.monotonic_ns(), so the captures share one timebase
+    and can be merged with recording.merge_recordings.
+    """
+
+    def __init__(self, engines):
+        """
+        :param engines: CaptureEngine instances, each driving its own device.
+        """
+        self.engines = list(engines)
+
+    def run(self):
+        """
+        Captures until every device stops sending data or the user presses Ctrl+C.
+        """
+        for engine in self.engines:
+            engine.start()
+        try:
+            while not all(engine.reader_done.wait(0.2) for engine in self.engines):
+                pass
+        except KeyboardInterrupt:
+            print("Data reading interrupted by user.")
+        # Signal every reader first, so the devices stop at nearly the same time
+        for engine in self.engines:
+            engine.stop_event.set()
+        for engine in self.engines:
+            engine.stop()
+
+    def stats(self):
+        return [engine.stats() for engine in self.engines]
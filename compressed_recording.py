@@ -0,0 +1,342 @@
+import os
+import struct
+import zlib
+import numpy as np
+from bin_to_csv import SnapshotParser, codes_to_dbm, read_binary_file
+from recording import COMPRESSED_EXTENSION, HEADER_SIZE, _pack_header, read_header, read_timestamps
+
+# Compressed recording layout: a header like the one of a recording (with its own magic), the chunks,
+# then the chunk index. Each chunk is a CHUNK_HEADER (compressed length, snapshots) followed by the
+# zlib-compressed payload: the raw int16 values delta-encoded along time (each row minus the previous one,
+# the first row as is) with the low bytes stored before the high bytes, then the int64 timestamp deltas.
+# The index holds one INDEX_DTYPE entry per chunk; the header gives its offset.
+COMPRESSED_MAGIC = b"TSACRC01"
+CHUNK_HEADER = struct.Struct("<II")
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('snapshots', '<u4'),
+                        ('first_snapshot', '<u8'), ('first_time', '<i8'), ('last_time', '<i8')])
+
+def _encode_chunk(codes, timestamps, level):
+    deltas = codes.copy()
+    deltas[1:] -= codes[:-1]  # int16 arithmetic wraps around, cumsum restores the values exactly
+    # Low and high bytes apart: the high bytes of small deltas are mostly 0 or 255 and compress well
+    payload = deltas.astype('<i2').view(np.uint8).reshape(-1, 2).T.tobytes()
+    if timestamps is not None:
+        payload += np.diff(timestamps, prepend=0).astype('<i8').tobytes()
+    return zlib.compress(payload, level)
+
+def _decode_chunk(data, snapshots, points, timestamps):
+    payload = zlib.decompress(data)
+    size = snapshots * points
+    deltas = np.frombuffer(payload, dtype=np.uint8, count=size * 2).reshape(2, size).T.copy().view('<i2')
+    codes = np.cumsum(deltas.reshape(snapshots, points), axis=0, dtype=np.int16)
+    times = None
+    if timestamps:
+        times = np.cumsum(np.frombuffer(payload, dtype='<i8', offset=size * 2, count=snapshots))
+    return codes, times
+
+class CompressedRecordingWriter:
+    """
+    Writes raw int16 snapshot values to a compressed recording in chunks of `chunk_size` snapshots.
+    Snapshot N, or the snapshot at time T, can be read back by decompressing a single chunk.
+    """
+
+    def __init__(self, filename, start_freq, stop_freq, points, chunk_size=1024, level=1, timestamps=True,
+                 **metadata):
+        """
+        :param filename: Path to the compressed recording file.
+        :param start_freq: Start frequency in Hz.
+        :param stop_freq: Stop frequency in Hz.
+        :param points: Number of points in each scan.
+        :param chunk_size: Number of snapshots compressed together.
+        :param level: zlib compression level, 1 is the fastest.
+        :param timestamps: Store the arrival time of every snapshot (required by write then).
+        :param metadata: Sweep settings and other values stored in the header.
+        """
+        self.filename = filename
+        self.points = points
+        self.chunk_size = chunk_size
+        self.level = level
+        self.timestamps = timestamps
+        self.metadata = dict(metadata, start_freq=start_freq, stop_freq=stop_freq, points=points,
+                             codec="zlib", chunk_size=chunk_size, timestamps=timestamps)
+        self.codes = np.empty((chunk_size, points), dtype=np.int16)
+        self.times = np.empty(chunk_size, dtype=np.int64)
+        self.buffered = 0
+        self.snapshots = 0
+        self.index = []
+        self.file = open(filename, "wb")
+        self.file.write(_pack_header(self.metadata, COMPRESSED_MAGIC))
+
+    def write(self, codes, timestamps=None):
+        """
+        Appends snapshots.
+
+        :param codes: Array of raw int16 values (each row is a snapshot).
+        :param timestamps: Arrival times of the snapshots in nanoseconds.
+        """
+        codes = np.asarray(codes).reshape(-1, self.points)
+        if self.timestamps and timestamps is None:
+            raise ValueError("Timestamps are required by this compressed recording")
+        written = 0
+        while written < len(codes):
+            count = min(len(codes) - written, self.chunk_size - self.buffered)
+            self.codes[self.buffered:self.buffered + count] = codes[written:written + count]
+            if self.timestamps:
+                self.times[self.buffered:self.buffered + count] = timestamps[written:written + count]
+            self.buffered += count
+            written += count
+            if self.buffered == self.chunk_size:
+                self._flush()
+
+    def _flush(self):
+        if not self.buffered:
+            return
+        codes = self.codes[:self.buffered]
+        times = self.times[:self.buffered] if self.timestamps else None
+        data = _encode_chunk(codes, times, self.level)
+        offset = self.file.tell()
+        self.file.write(CHUNK_HEADER.pack(len(data), self.buffered))
+        self.file.write(data)
+        self.index.append((offset, len(data), self.buffered, self.snapshots,
+                           times[0] if self.timestamps else 0, times[-1] if self.timestamps else 0))
+        self.snapshots += self.buffered
+        self.buffered = 0
+
+    def close(self, **metadata):
+        """
+        Compresses the last chunk, writes the chunk index and updates the header.
+
+        :param metadata: Values known only at the end of the capture, e.g. capture_duration_ms.
+        """
+        if self.file.closed:
+            return
+        self._flush()
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        self.metadata.update(metadata, snapshots=self.snapshots, chunks=len(self.index), index_offset=index_offset)
+        self.file.seek(0)
+        self.file.write(_pack_header(self.metadata, COMPRESSED_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _scan_chunks(f, points, timestamps):
+    """
+    Rebuilds the chunk index of a compressed recording that was not closed, from the chunk headers.
+    """
+    index = []
+    offset = HEADER_SIZE
+    first_snapshot = 0
+    while True:
+        f.seek(offset)
+        header = f.read(CHUNK_HEADER.size)
+        if len(header) < CHUNK_HEADER.size:
+            break
+        length, snapshots = CHUNK_HEADER.unpack(header)
+        data = f.read(length)
+        try:
+            _, times = _decode_chunk(data, snapshots, points, timestamps)
+        except (zlib.error, ValueError):
+            break  # Incomplete last chunk
+        index.append((offset, length, snapshots, first_snapshot,
+                      times[0] if timestamps else 0, times[-1] if timestamps else 0))
+        offset += CHUNK_HEADER.size + length
+        first_snapshot += snapshots
+    return np.array(index, dtype=INDEX_DTYPE)
+
+class CompressedRecording:
+    """
+    Read access to a compressed recording. Indexing and slicing return dBm values like a recording memmap,
+    only the chunks holding the requested snapshots are decompressed (the last one is kept).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.metadata = read_header(filename, COMPRESSED_MAGIC)
+        self.points = self.metadata["points"]
+        self.has_timestamps = self.metadata.get("timestamps", False)
+        self.frequencies = np.linspace(self.metadata["start_freq"], self.metadata["stop_freq"], self.points)
+        self.file = open(filename, "rb")
+        if "index_offset" in self.metadata:
+            self.file.seek(self.metadata["index_offset"])
+            self.index = np.frombuffer(self.file.read(self.metadata["chunks"] * INDEX_DTYPE.itemsize),
+                                       dtype=INDEX_DTYPE)
+        else:
+            self.index = _scan_chunks(self.file, self.points, self.has_timestamps)
+        self.snapshot_count = int(self.index['snapshots'].sum()) if len(self.index) else 0
+        self.cached_chunk = None
+
+    def __len__(self):
+        return self.snapshot_count
+
+    @property
+    def shape(self):
+        return (self.snapshot_count, self.points)
+
+    ndim = 2
+    dtype = np.dtype(np.float64)
+
+    def chunk(self, number):
+        """
+        Decompresses one chunk.
+
+        :return: A tuple of (codes, timestamps) where timestamps is None without stored timestamps.
+        """
+        if self.cached_chunk is None or self.cached_chunk[0] != number:
+            entry = self.index[number]
+            self.file.seek(int(entry['offset']) + CHUNK_HEADER.size)
+            data = self.file.read(int(entry['length']))
+            self.cached_chunk = (number, _decode_chunk(data, int(entry['snapshots']), self.points,
+                                                       self.has_timestamps))
+        return self.cached_chunk[1]
+
+    def codes(self, start, stop):
+        """
+        Returns the raw int16 values of snapshots start to stop, with their timestamps (or None).
+        """
+        start, stop, _ = slice(start, stop).indices(self.snapshot_count)
+        if stop <= start:
+            return np.empty((0, self.points), dtype=np.int16), np.empty(0, dtype=np.int64)
+        first = np.searchsorted(self.index['first_snapshot'], start, side="right") - 1
+        last = np.searchsorted(self.index['first_snapshot'], stop - 1, side="right") - 1
+        codes, times = [], []
+        for number in range(first, last + 1):
+            chunk_codes, chunk_times = self.chunk(number)
+            offset = int(self.index['first_snapshot'][number])
+            selected = slice(max(start - offset, 0), min(stop - offset, len(chunk_codes)))
+            codes.append(chunk_codes[selected])
+            if chunk_times is not None:
+                times.append(chunk_times[selected])
+        return np.concatenate(codes), np.concatenate(times) if times else None
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self.snapshot_count
+            if not 0 <= key < self.snapshot_count:
+                raise IndexError("snapshot index out of range")
+            return codes_to_dbm(self.codes(key, key + 1)[0][0])
+        if isinstance(key, slice) and key.step in (None, 1):
+            return codes_to_dbm(self.codes(key.start, key.stop)[0])
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        snapshots = self[:]
+        return snapshots if dtype is None else snapshots.astype(dtype)
+
+    def timestamps(self):
+        """
+        :return: Arrival times of all snapshots in nanoseconds, None if the recording has no timestamps.
+        """
+        if not self.has_timestamps:
+            return None
+        if not self.snapshot_count:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.chunk(number)[1] for number in range(len(self.index))])
+
+    def index_at_time(self, timestamp):
+        """
+        Finds the first snapshot that arrived at or after `timestamp` (nanoseconds), decompressing one chunk.
+        """
+        if not self.has_timestamps:
+            raise ValueError(f"{self.filename} has no timestamps")
+        number = np.searchsorted(self.index['last_time'], timestamp)
+        if number == len(self.index):
+            return self.snapshot_count
+        times = self.chunk(number)[1]
+        return int(self.index['first_snapshot'][number]) + int(np.searchsorted(times, timestamp))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CaptureCompressor:
+    """
+    Compresses a capture while it runs, on the writer thread of a capture.CaptureEngine, instead of writing
+    the binary file and converting it afterwards. Batches of raw scanraw snapshots are parsed (resynchronizing
+    like the converter) and appended to a compressed recording with their arrival times.
+    """
+
+    def __init__(self, filename, start_freq, stop_freq, points, chunk_size=1024, level=1, metrics=None, **metadata):
+        """
+        :param filename: Path to the compressed recording file.
+        :param metrics: Optional metrics.Metrics counting the parsed bytes, snapshots and malformed frames.
+        :param metadata: Sweep settings and other values stored in the header.
+        """
+        self.parser = SnapshotParser(points, codes=True)
+        self.recording = CompressedRecordingWriter(filename, start_freq, stop_freq, points, chunk_size, level,
+                                                   **metadata)
+        self.metrics = metrics
+        self.slots = 0  # Snapshot slots received so far, the ring stores one arrival time per slot
+
+    def write(self, snapshots, timestamps):
+        """
+        Appends a batch of raw snapshots.
+
+        :param snapshots: Bytes-like object of whole snapshot slots of the capture ring.
+        :param timestamps: Arrival time of every slot in nanoseconds.
+        """
+        skipped, resyncs = self.parser.skipped, self.parser.resyncs
+        codes = self.parser.feed(snapshots)
+        if self.metrics is not None:
+            self.metrics.inc("converter_bytes_total", len(snapshots))
+            self.metrics.inc("converter_snapshots_total", len(codes))
+            self.metrics.inc("converter_skipped_bytes_total", self.parser.skipped - skipped)
+            self.metrics.inc("converter_malformed_frames_total", self.parser.resyncs - resyncs)
+        if len(codes):
+            slots = self.parser.closing_slots() - self.slots
+            self.recording.write(codes, np.asarray(timestamps)[np.clip(slots, 0, len(timestamps) - 1)])
+        self.slots += len(timestamps)
+
+    def close(self, **metadata):
+        """
+        Writes the last chunk and the index.
+
+        :param metadata: Values known only at the end of the capture, e.g. capture_duration_ms.
+        """
+        self.parser.finish()
+        self.recording.close(skipped_bytes=self.parser.skipped, **metadata)
+
+def bin_to_compressed(input_file, output_file, points, start_freq, stop_freq, scan_duration, buffer_size=4096,
+                      chunk_size=1024, level=1, metrics=None, **settings):
+    """
+    Parse binary data from a file and convert it to a compressed recording of raw values.
+    The arrival times saved by the capture (input_file + TIMESTAMPS_SUFFIX) are stored when they exist.
+
+    :param input_file: Path to the binary data file.
+    :param output_file: Path to the output compressed recording file.
+    :param points: Number of points expected in each scan.
+    :param start_freq: Start frequency in Hz.
+    :param stop_freq: Stop frequency in Hz.
+    :param scan_duration: Duration of the capture in ms.
+    :param buffer_size: Number of snapshots to read from file in one buffer.
+    :param chunk_size: Number of snapshots compressed together.
+    :param level: zlib compression level.
+    :param metrics: Optional metrics.Metrics for the conversion.
+    :param settings: Sweep settings (sweep mode, rbw, spur) stored in the header.
+    :return: None
+    """
+    parser = SnapshotParser(points, codes=True)
+    arrivals = read_timestamps(input_file)
+    has_timestamps = arrivals is not None and len(arrivals) > 0
+    with CompressedRecordingWriter(output_file, start_freq, stop_freq, points, chunk_size, level,
+                                   has_timestamps, **settings) as recording:
+        for codes in read_binary_file(input_file, points, buffer_size, parser, metrics):
+            timestamps = None
+            if has_timestamps:
+                timestamps = arrivals[np.minimum(parser.closing_slots(), len(arrivals) - 1)]
+            recording.write(codes, timestamps)
+        recording.close(capture_duration_ms=scan_duration, skipped_bytes=parser.skipped)
+
+    ratio = os.path.getsize(input_file) / max(os.path.getsize(output_file), 1)
+    print(f"Compressed recording written to {output_file} with {recording.snapshots} snapshots "
+          f"({ratio:.1f}x smaller than the capture).")
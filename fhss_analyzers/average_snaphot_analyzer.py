@@ -1,6 +1,8 @@
+import sys
 import numpy as np
 from scipy.signal import find_peaks
-from utils import calculate_euclidean_distance,plot_averaged_snapshot_with_peaks,read_csv_data
+from utils import calculate_euclidean_distance,plot_averaged_snapshot_with_peaks,read_data,SnapshotAccumulator,iterate_batches
+from recording import first_snapshots  # On the path through utils
 
 def average_snapshots(snapshots, num_snapshots, threshold=-50):
     """
@@ -18,29 +20,70 @@ def average_snapshots(snapshots, num_snapshots, threshold=-50):
     # Compute the mean, ignoring NaN values
     return np.nanmean(valid_values, axis=0)
 
+class StreamingAverager(SnapshotAccumulator):
+    """
+    Incremental version of average_snapshots: keeps per-frequency sums and counts of the values
+    above the threshold, so snapshots can be fed in batches from unbounded captures or live streams.
+    """
+
+    def __init__(self, points, threshold=-50):
+        """
+        :param points: Number of points in each snapshot.
+        :param threshold: The dBm threshold for considering values in the average.
+        """
+        super().__init__(points)
+        self.threshold = threshold
+        self.sums = np.zeros(points)
+        self.counts = np.zeros(points, dtype=np.int64)
+
+    def _accumulate(self, snapshots):
+        mask = snapshots > self.threshold  # Mask values above the threshold
+        self.sums += np.sum(snapshots, axis=0, where=mask)
+        self.counts += np.count_nonzero(mask, axis=0)
+
+    def average(self):
+        """
+        :return: An array of averaged dBm values, NaN where no value was above the threshold.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 0, self.sums / self.counts, np.nan)
+
 def remove_local_minima(averaged_snapshot, threshold):
     """
     Removes local minima in the averaged snapshot that are above the specified threshold 
-    by replacing them with the average of their neighbors.
-    After replacing, the function starts from the i-1 point.
+    by replacing them with the average of their neighbors, until no such minima remain.
+    The local minima of the input are found in one vectorized pass. A replacement raises a value,
+    so only its two neighbors can become new local minima: they are pushed on a stack and checked
+    next (the left one first), instead of re-scanning the snapshot from i-1.
+    The work is linear in the number of points plus the number of replacements.
     
     :param averaged_snapshot: Array of averaged dBm values across all snapshots.
     :param threshold: Minimum dBm value for local minima to be replaced.
     :return: Modified snapshot with local minima removed.
     """
-    i = 1  # Start from the second element
-    while i < len(averaged_snapshot) - 1:
-        # print(i)
+    if len(averaged_snapshot) < 3:
+        return averaged_snapshot
+
+    inner = averaged_snapshot[1:-1]
+    minima = np.flatnonzero((inner < averaged_snapshot[:-2]) &
+                            (inner < averaged_snapshot[2:]) &
+                            (inner > threshold)) + 1
+    values = averaged_snapshot.tolist()  # Python floats are much faster to update one by one
+    last = len(values) - 1
+    pending = minima[::-1].tolist()  # Stack of points to check, lowest index on top
+
+    while pending:
+        i = pending.pop()
         # Check if it's a local minimum and if it's above the threshold
-        if (averaged_snapshot[i] < averaged_snapshot[i - 1] and 
-            averaged_snapshot[i] < averaged_snapshot[i + 1] and 
-            averaged_snapshot[i] > threshold):
+        if (0 < i < last and values[i] < values[i - 1] and
+            values[i] < values[i + 1] and values[i] > threshold):
             # Replace with the average of its neighbors
-            averaged_snapshot[i] = (averaged_snapshot[i - 1] + averaged_snapshot[i+1]) /2
-            # After modification, step back to i-1 to re-evaluate
-            i = max(1, i - 1)  # Ensure we don't go out of bounds
-        else:
-            i += 1  # Move to the next point only if no modification was made
+            values[i] = (values[i - 1] + values[i + 1]) / 2
+            # The neighbors may have become local minima, re-evaluate i-1 first
+            pending.append(i + 1)
+            pending.append(i - 1)
+
+    averaged_snapshot[:] = values
     return averaged_snapshot
 
 def find_carriers(frequencies, averaged_snapshot, threshold=-50):
@@ -65,6 +108,30 @@ def find_carriers(frequencies, averaged_snapshot, threshold=-50):
     peak_frequencies = frequencies[peaks]
 
     return peak_frequencies, len(peak_frequencies)
+
+def analyze(filename, threshold=-40, num_snapshots=None):
+    """
+    Averages a recording or CSV file batch by batch and finds the carriers, without plotting.
+    
+    :param filename: Path to the .rec recording or CSV file.
+    :param threshold: Only values above this dBm threshold are averaged, carriers are searched above threshold/2.
+    :param num_snapshots: Average only snapshots[:num_snapshots], all of them if None.
+    :return: Dictionary with the number of snapshots, the carriers, the frequencies and the averaged snapshot.
+    """
+    frequencies, snapshots = read_data(filename)
+    snapshots = first_snapshots(snapshots, num_snapshots)
+    averager = StreamingAverager(len(frequencies), threshold)
+    for batch in iterate_batches(snapshots):
+        averager.update(batch)
+    averaged_snapshot = averager.average()
+    peak_frequencies, num_carriers = find_carriers(frequencies, averaged_snapshot, threshold / 2)
+    return {
+        "snapshots": len(snapshots),
+        "num_carriers": num_carriers,
+        "carriers": peak_frequencies,
+        "frequencies": frequencies,
+        "averaged_snapshot": averaged_snapshot
+    }
     
 if __name__ == "__main__":
     # csv_file = "recordings/outputslowarm_start865000000.0_stop868000000.0_points100.csv"  # Path to the CSV file
@@ -72,16 +139,15 @@ if __name__ == "__main__":
     csv_file = "../recordings/outputfast_start865000000.0_stop871000000.0_points200.csv"
     # csv_file = "recordings\outputnew_start865000000.0_stop871000000.0_points200.csv"
     # csv_file = "recordings\outputfast_start865000000.0_stop871000000.0_points450.csv"
+    if len(sys.argv) > 1:
+        csv_file = sys.argv[1]
     num_snapshots = -1  # Specify the number of snapshots to average
     threshold_for_averaging = -40  # Only consider values above this threshold for averaging
 
-    # # Read the CSV file and extract frequency and snapshot data
-    frequencies, snapshots = read_csv_data(csv_file)
-
-    averaged_snapshot = average_snapshots(snapshots, num_snapshots,threshold= threshold_for_averaging)
-
-    # Find the carriers (peaks) and their corresponding frequencies in the averaged snapshot
-    peak_frequencies, num_carriers = find_carriers(frequencies, averaged_snapshot, threshold_for_averaging/2)
+    # Average the recording or CSV file and find the carriers (peaks) and their corresponding frequencies
+    result = analyze(csv_file, threshold_for_averaging, num_snapshots)
+    frequencies, averaged_snapshot = result["frequencies"], result["averaged_snapshot"]
+    peak_frequencies, num_carriers = result["carriers"], result["num_carriers"]
 
     # Print the results
     print(f"Number of carriers: {num_carriers}")
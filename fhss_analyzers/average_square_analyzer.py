@@ -1,6 +1,7 @@
+import sys
 import numpy as np
 from scipy.signal import find_peaks
-from utils import calculate_euclidean_distance,plot_averaged_snapshot_with_peaks,read_csv_data
+from utils import calculate_euclidean_distance,plot_averaged_snapshot_with_peaks,read_data,SnapshotAccumulator,iterate_batches
 
 def scale_snapshots(snapshots):
     # Calculate the minimum and maximum values along the last two axes (for each 2D snapshot)
@@ -23,6 +24,31 @@ def square_and_average_snapshots(snapshots):
     # print(average_value)
     return average_value
     
+class StreamingSquareAverager(SnapshotAccumulator):
+    """
+    Incremental version of square_and_average_snapshots(scale_snapshots(snapshots)).
+    Scaling is done per snapshot, so each batch is scaled on its own and only per-frequency sums
+    and counts of the power-16 values are kept.
+    """
+
+    def __init__(self, points):
+        super().__init__(points)
+        self.sums = np.zeros(points)
+        self.counts = np.zeros(points, dtype=np.int64)
+
+    def _accumulate(self, snapshots):
+        squared_snapshots = scale_snapshots(snapshots) ** 16
+        valid = ~np.isnan(squared_snapshots)
+        self.sums += np.sum(squared_snapshots, axis=0, where=valid)
+        self.counts += np.count_nonzero(valid, axis=0)
+
+    def average(self):
+        """
+        :return: The average of the scaled power-16 values for each frequency.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 0, self.sums / self.counts, np.nan)
+
 def find_carriers(frequencies, avereged_snaphot):
     min_distance = len(frequencies)//20  # Minimum number of data points between peaks
 
@@ -32,6 +58,28 @@ def find_carriers(frequencies, avereged_snaphot):
     peak_frequencies = frequencies[peaks]
     return peak_frequencies
 
+def analyze(filename):
+    """
+    Averages the scaled power-16 snapshots of a recording or CSV file batch by batch and finds the carriers,
+    without plotting.
+    
+    :param filename: Path to the .rec recording or CSV file.
+    :return: Dictionary with the number of snapshots, the carriers, the frequencies and the averaged snapshot.
+    """
+    frequencies, snapshots = read_data(filename)
+    averager = StreamingSquareAverager(len(frequencies))
+    for batch in iterate_batches(snapshots):
+        averager.update(batch)
+    averaged_snapshot = averager.average()
+    peaks = find_carriers(frequencies, averaged_snapshot)
+    return {
+        "snapshots": len(snapshots),
+        "num_carriers": len(peaks),
+        "carriers": peaks,
+        "frequencies": frequencies,
+        "averaged_snapshot": averaged_snapshot
+    }
+
 if __name__ == "__main__":
     # csv_file = "recordings/outputslowarm_start865000000.0_stop868000000.0_points100.csv"  # Path to the CSV file
     # csv_file = "recordings\output1_start865000000.0_stop871000000.0_points200.csv"
@@ -39,13 +87,12 @@ if __name__ == "__main__":
     # csv_file = "recordings\outputnew_start865000000.0_stop871000000.0_points200.csv"
     # csv_file = "../recordings/outputfast_start865000000.0_stop871000000.0_points450.csv"
 
-    # # Read the CSV file and extract frequency and snapshot data
-    frequencies, snapshots = read_csv_data(csv_file)
-
-    scaled_snaphots = scale_snapshots(snapshots)
-    avereged_snaphot = square_and_average_snapshots(scaled_snaphots)
+    if len(sys.argv) > 1:
+        csv_file = sys.argv[1]
 
-    peaks = find_carriers(frequencies, avereged_snaphot)
+    # Average the recording or CSV file and find the carriers
+    result = analyze(csv_file)
+    frequencies, avereged_snaphot, peaks = result["frequencies"], result["averaged_snapshot"], result["carriers"]
     print(f"Number of carriers {len(peaks)}")
     print(f"Carriers {peaks}")
 
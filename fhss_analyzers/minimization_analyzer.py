@@ -1,21 +1,41 @@
+import sys
 import numpy as np
 from scipy.signal import find_peaks
-from utils import calculate_euclidean_distance,plot_averaged_snapshot_with_peaks,read_csv_data,ternary_search,scale_snapshots
+from utils import calculate_euclidean_distance,plot_averaged_snapshot_with_peaks,read_data,scale_snapshots
 from scipy.optimize import minimize_scalar
+from concurrent.futures import ProcessPoolExecutor
 from average_square_analyzer import square_and_average_snapshots, find_carriers
+from average_square_analyzer import analyze as average_square
 
 # Cost function: sum of squared differences between snapshot values and nearest carrier values
 def cost_function(f_start, f_spread, num_carriers, averaged_snapshot, frequencies):
-    cost = 0
+    return float(batch_cost_function(f_start, f_spread, num_carriers, averaged_snapshot, frequencies))
+
+def batch_cost_function(f_starts, f_spreads, num_carriers, averaged_snapshot, frequencies, chunk_size=1024):
+    """
+    Evaluates cost_function for many (f_start, f_spread) candidates at once.
+    
+    :param f_starts: Candidate start frequencies, broadcast against f_spreads.
+    :param f_spreads: Candidate frequency spreads.
+    :param num_carriers: Number of carriers.
+    :param averaged_snapshot: Array of averaged values, NaN values are ignored.
+    :param frequencies: Array of frequency values.
+    :param chunk_size: Number of candidates evaluated in one vectorized step, bounds the temporary memory.
+    :return: Array of costs with the broadcast shape of f_starts and f_spreads.
+    """
+    f_starts, f_spreads = np.broadcast_arrays(np.asarray(f_starts, dtype=float), np.asarray(f_spreads, dtype=float))
+    valid = ~np.isnan(averaged_snapshot)
+    weights = averaged_snapshot[valid]
+    valid_frequencies = frequencies[valid]
     max_f = np.max(frequencies)
-    for i in range(len(averaged_snapshot)):
-        if np.isnan(averaged_snapshot[i]):
-            continue
-        nearest = nearest_carrier(frequencies[i], f_start, f_spread, num_carriers)
-        cost += (((frequencies[i] - nearest)/max_f)**2)*averaged_snapshot[i]
 
-    # print(f"f_start={f_start}, cost={cost}")
-    return cost
+    starts = f_starts.ravel()
+    spreads = f_spreads.ravel()
+    costs = np.empty(starts.size)
+    for i in range(0, starts.size, chunk_size):
+        nearest = nearest_carrier(valid_frequencies, starts[i:i + chunk_size, None], spreads[i:i + chunk_size, None], num_carriers)
+        costs[i:i + chunk_size] = (((valid_frequencies - nearest) / max_f) ** 2) @ weights
+    return costs.reshape(f_starts.shape)
 
 # Function to optimize the start frequency using minimize_scalar
 def optimize_start_frequency(f_spread, num_carriers, averaged_snapshot, frequencies, search_range):
@@ -29,13 +49,123 @@ def optimize_start_frequency(f_spread, num_carriers, averaged_snapshot, frequenc
     # Return the optimized start frequency and the cost
     return result.x, result.fun
 
-# Function to find the nearest carrier for a given index
+# Function to find the nearest carrier for a given frequency
 def nearest_carrier(freq, f_start, f_spread, num_carriers):
-    # Compute the position of all carriers
-    carrier_positions = f_start + np.arange(num_carriers) * f_spread
+    """
+    Finds the nearest of the carriers f_start + k * f_spread, k = 0..num_carriers-1, in closed form.
+    All arguments except num_carriers may be arrays and are broadcast against each other.
+    """
+    freq, f_start, f_spread = np.broadcast_arrays(freq, f_start, f_spread)
+    # Index of the nearest carrier, clipped to the carriers that exist
+    index = np.divide(freq - f_start, f_spread, out=np.zeros(freq.shape), where=f_spread != 0)
+    index = np.clip(np.rint(index), 0, num_carriers - 1)
+    return f_start + index * f_spread
+
+def _evaluate_grid(f_starts, f_spreads, num_carriers, averaged_snapshot, frequencies, executor=None, processes=None):
+    # Costs of all candidate pairs, split into one tile per worker process
+    if executor is None:
+        return batch_cost_function(f_starts, f_spreads, num_carriers, averaged_snapshot, frequencies)
+    tiles = np.array_split(np.arange(len(f_starts)), processes)
+    costs = executor.map(batch_cost_function,
+                         [f_starts[tile] for tile in tiles], [f_spreads[tile] for tile in tiles],
+                         [num_carriers] * len(tiles), [averaged_snapshot] * len(tiles), [frequencies] * len(tiles))
+    return np.concatenate(list(costs))
+
+def grid_search(num_carriers, averaged_snapshot, frequencies, start_range, spread_range=None,
+                grid_size=64, refine_size=16, stages=6, keep=4, processes=None):
+    """
+    Finds the (f_start, f_spread) pair minimizing cost_function with a coarse-to-fine grid search.
+    The first stage evaluates a grid_size x grid_size grid over the whole ranges, every next stage
+    evaluates a refine_size x refine_size grid spanning one cell around each of the `keep` best
+    candidates of the previous stage. Unlike the nested ternary search it does not assume a unimodal
+    cost, and it is deterministic.
+    
+    :param num_carriers: Number of carriers.
+    :param averaged_snapshot: Array of averaged values, NaN values are ignored.
+    :param frequencies: Array of frequency values.
+    :param start_range: (min, max) of the start frequency.
+    :param spread_range: (min, max) of the frequency spread, by default up to the spread that fits
+                         all carriers into start_range.
+    :param grid_size: Number of grid points along each axis of the coarse grid.
+    :param refine_size: Number of grid points along each axis of the refined grids, each stage
+                        refines the grid step by a factor of (refine_size - 1) / 2.
+    :param stages: Number of stages including the coarse one.
+    :param keep: Number of best candidates refined in the next stage.
+    :param processes: Number of worker processes evaluating grid tiles, None to evaluate in this process.
+    :return: A dictionary with the optimal "f_start", "f_spread" and "cost", and "surfaces": a list with
+             one (f_starts, f_spreads, costs) tuple of flat arrays per stage, the first one being the
+             grid_size x grid_size coarse cost surface.
+    """
+    if spread_range is None:
+        spread_range = (0, (start_range[1] - start_range[0]) / max(num_carriers - 1, 1))
+    lower = np.array([start_range[0], spread_range[0]], dtype=float)
+    upper = np.array([start_range[1], spread_range[1]], dtype=float)
+    step = (upper - lower) / (grid_size - 1)
+    size = grid_size
+
+    centers = [(lower + upper) / 2]
+    surfaces = []
+    executor = ProcessPoolExecutor(processes) if processes else None
+    try:
+        for _ in range(stages):
+            # Candidate grids around every center, clipped to the search ranges
+            offsets = np.arange(size) - (size - 1) / 2
+            f_starts = np.concatenate([np.repeat(center[0] + offsets * step[0], size) for center in centers])
+            f_spreads = np.concatenate([np.tile(center[1] + offsets * step[1], size) for center in centers])
+            f_starts = np.clip(f_starts, lower[0], upper[0])
+            f_spreads = np.clip(f_spreads, lower[1], upper[1])
+
+            costs = _evaluate_grid(f_starts, f_spreads, num_carriers, averaged_snapshot, frequencies, executor, processes)
+            surfaces.append((f_starts, f_spreads, costs))
+
+            best = np.argsort(costs, kind="stable")[:keep]
+            centers = [np.array([f_starts[i], f_spreads[i]]) for i in best]
+            # The next grid spans one cell on each side of a center
+            size = refine_size
+            step = 2 * step / (size - 1)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Clipping may repeat candidates, the best one of all stages is the optimum
+    f_starts, f_spreads, costs = (np.concatenate(values) for values in zip(*surfaces))
+    best = np.argmin(costs)
+    return {
+        "f_start": f_starts[best],
+        "f_spread": f_spreads[best],
+        "cost": costs[best],
+        "surfaces": surfaces
+    }
+
+def analyze(filename, start=865e6, end=870e6, processes=None):
+    """
+    Fits evenly spaced carriers to the scaled power-16 average of a recording or CSV file, without plotting.
+    The number of carriers is the number of peaks found by average_square_analyzer.
     
-    # Find the closest carrier to the given index
-    return carrier_positions[np.argmin(np.abs(carrier_positions - freq))]
+    :param filename: Path to the .rec recording or CSV file.
+    :param start: Lowest carrier frequency considered, in Hz.
+    :param end: Frequencies above end are ignored, in Hz.
+    :param processes: Number of worker processes of the grid search, single process if None.
+    :return: Dictionary with the fitted start, spread and cost, the carriers, the frequencies and the averaged snapshot.
+    """
+    averaged = average_square(filename)
+    num_carriers = averaged["num_carriers"]
+    # Remove the frequencies bigger than 'end' and the corresponding averaged values
+    kept = np.searchsorted(averaged["frequencies"], end, side="right")
+    frequencies = averaged["frequencies"][:kept]
+    averaged_snapshot = averaged["averaged_snapshot"][:kept]
+
+    result = grid_search(num_carriers, averaged_snapshot, frequencies, [start, end], processes=processes)
+    return {
+        "snapshots": averaged["snapshots"],
+        "num_carriers": num_carriers,
+        "f_start": result["f_start"],
+        "f_spread": result["f_spread"],
+        "cost": result["cost"],
+        "carriers": result["f_start"] + np.arange(num_carriers) * result["f_spread"],
+        "frequencies": frequencies,
+        "averaged_snapshot": averaged_snapshot
+    }
 
 if __name__ == "__main__":
     # csv_file = "recordings/outputslowarm_start865000000.0_stop868000000.0_points100.csv"  # Path to the CSV file
@@ -46,32 +176,19 @@ if __name__ == "__main__":
     # csv_file = "recordings\outputnew_start865000000.0_stop871000000.0_points200.csv"
     # csv_file = "../recordings/outputfast_start865000000.0_stop871000000.0_points450.csv"
 
-    # Read the CSV file and extract frequency and snapshot data
-    frequencies, snapshots = read_csv_data(csv_file)
-    scaled_snaphots = scale_snapshots(snapshots)
-    averaged_snapshot = square_and_average_snapshots(scaled_snaphots)
-    peaks = find_carriers(frequencies, averaged_snapshot)
-    num_carriers = len(peaks)
-    start = 865*1000*1000
-    end = 870*1000*1000
-    # Find the first frequency that is bigger than 'end' and remove all frequencies that are bigger than 'end' from 'frequencies'
-    # Also, remove corresponding values from 'averaged_snapshot'
-    first_index_bigger_than_end = np.argmax(frequencies > end)
-    frequencies = frequencies[:first_index_bigger_than_end]
-    averaged_snapshot = averaged_snapshot[:first_index_bigger_than_end]
-
-    def cost_function_for_freq_spread(freq_spread):
-        _, cost = optimize_start_frequency(freq_spread, num_carriers, averaged_snapshot, frequencies, [start, end])
-        return cost
-
-    f_spread_opt = ternary_search(cost_function_for_freq_spread, 0, 1000*1000*10)
-    f_start_opt, cost = optimize_start_frequency(f_spread_opt, num_carriers, averaged_snapshot, frequencies, [start, end])
+    if len(sys.argv) > 1:
+        csv_file = sys.argv[1]
+
+    # Average the recording or CSV file and fit the carriers between start and end
+    result = analyze(csv_file, 865*1000*1000, 870*1000*1000)
+    frequencies, averaged_snapshot = result["frequencies"], result["averaged_snapshot"]
+    f_start_opt, f_spread_opt, cost = result["f_start"], result["f_spread"], result["cost"]
     print(f"cost={cost}")
     print(f"start frequency={f_start_opt}")
     print(f"frequency spread={f_spread_opt}")
 
-    # Generate the optimized carrier positions
-    optimized_carriers = f_start_opt + np.arange(num_carriers) * f_spread_opt
+    # The optimized carrier positions
+    optimized_carriers = result["carriers"]
 
     print(f"Number of carriers {len(optimized_carriers)}")
     print(f"Carriers {optimized_carriers}")
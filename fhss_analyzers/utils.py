@@ -1,28 +1,71 @@
-
-import csv
+import os
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
+
+# The recording format is shared with the scanner in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from recording import load_csv_cached, load_snapshots
 
 def read_csv_data(csv_file):
     """
     Reads the CSV file and returns frequency and snapshot data.
+    The CSV file is parsed once, later reads come from a binary cache next to it.
     
     :param csv_file: Path to the CSV file.
     :return: A tuple of (frequencies, snapshots).
     """
-    frequencies = []
-    snapshots = []
+    return load_csv_cached(csv_file)
+
+def read_data(filename):
+    """
+    Reads a recording (memory-mapped, only touched pages are loaded) or a CSV file.
+    
+    :param filename: Path to a .rec recording or a CSV file.
+    :return: A tuple of (frequencies, snapshots).
+    """
+    return load_snapshots(filename)
+
+class SnapshotAccumulator:
+    """
+    Base class for per-frequency running statistics over batches of snapshots.
+    Only O(points) state is kept, so captures of any length can be processed batch by batch.
+    Tracks the number of snapshots and the per-frequency minimum and maximum (NaN values are ignored).
+    """
 
-    with open(csv_file, 'r') as f:
-        reader = csv.reader(f)
-        header = next(reader)  # First row is the header with frequencies
-        frequencies = np.array([float(freq.split()[0]) for freq in header[1:]])
+    def __init__(self, points):
+        self.points = points
+        self.num_snapshots = 0
+        self.minimum = np.full(points, np.nan)
+        self.maximum = np.full(points, np.nan)
+
+    def update(self, snapshots):
+        """
+        Adds a batch of snapshots.
+        
+        :param snapshots: Array of snapshot values (each row is a snapshot).
+        :return: self, so updates can be chained.
+        """
+        snapshots = np.asarray(snapshots).reshape(-1, self.points)
+        if len(snapshots):
+            self.num_snapshots += len(snapshots)
+            self.minimum = np.fmin(self.minimum, np.fmin.reduce(snapshots, axis=0))
+            self.maximum = np.fmax(self.maximum, np.fmax.reduce(snapshots, axis=0))
+            self._accumulate(snapshots)
+        return self
 
-        for row in reader:
-            snapshots.append([float(dbm) for dbm in row[1:]])
+    def _accumulate(self, snapshots):
+        pass
 
-    snapshots = np.array(snapshots)  # Convert to numpy array for easier processing
-    return frequencies, snapshots
+def iterate_batches(snapshots, batch_size=4096):
+    """
+    Splits a snapshot matrix (e.g. a memory-mapped recording) into batches of rows.
+    
+    :param snapshots: Array of snapshot values (each row is a snapshot).
+    :param batch_size: Number of snapshots in each batch.
+    :return: Yields consecutive batches of snapshots.
+    """
+    for start in range(0, len(snapshots), batch_size):
+        yield snapshots[start:start + batch_size]
 
 def plot_averaged_snapshot_with_peaks(frequencies, averaged_snapshot, peak_frequencies):
     """
@@ -32,6 +75,9 @@ def plot_averaged_snapshot_with_peaks(frequencies, averaged_snapshot, peak_frequ
     :param averaged_snapshot: Array of averaged dBm values across all snapshots.
     :param peak_frequencies: List of detected peak frequencies.
     """
+    # Imported here so the analyses can run headless without loading matplotlib
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(10, 6))
     plt.plot(frequencies, averaged_snapshot, label="Averaged Snapshot (dBm)")
     
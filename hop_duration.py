@@ -1,88 +1,132 @@
-import csv
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
-from collections import defaultdict
+from recording import batch_rows, load_snapshots, load_timestamps, read_sweep_period, threshold_operands
 
-def read_csv_for_fhss_analysis(csv_file, dBm_threshold=-90):
+# Sweep period measured for 25 points in fast mode, used when the recording has no timing metadata
+DEFAULT_SCAN_PERIOD = 0.0107
+
+def occupancy_matrix(snapshots, dBm_threshold, batch_size=None):
     """
-    Reads the CSV file, extracts snapshots, and analyzes frequency hop duration.
+    Builds the boolean occupancy matrix (snapshots x bins) of the frequencies above the threshold.
+    Rows are packed into bits, so a million snapshots of 1000 points take 125 MB.
+    Recordings of raw values are compared in code space, without converting them to dBm.
     
-    :param csv_file: Path to the CSV file.
+    :param snapshots: Array of snapshot dBm values (each row is a snapshot), e.g. a memory-mapped recording.
     :param dBm_threshold: dBm threshold to identify a frequency as a carrier.
+    :param batch_size: Number of snapshots compared with the threshold at once, BATCH_BYTES of float64 values if None.
+    :return: Array of packed occupancy rows (np.packbits along the bins).
     """
-    
-    frequencies = []
-    snapshots = []
-
-    with open(csv_file, 'r') as f:
-        reader = csv.reader(f)
-        header = next(reader)  # First row is the header with frequencies
-        
-        # Extract frequencies from the header (ignoring 'Snapshot' label)
-        frequencies = [float(freq.split()[0]) for freq in header[1:]]
-        
-        # Read the snapshot data (dBm values)
-        for row in reader:
-            snapshots.append([float(dbm) for dbm in row[1:]])
+    values, threshold = threshold_operands(snapshots, dBm_threshold)
+    batch_size = batch_size or batch_rows(snapshots.shape[1])
+    batches = [np.packbits(values[start:start + batch_size] > threshold, axis=1)
+               for start in range(0, len(values), batch_size)]
+    if not batches:
+        return np.empty((0, (snapshots.shape[1] + 7) // 8), dtype=np.uint8)
+    return np.concatenate(batches)
 
-    # Convert to numpy arrays for easier analysis
-    frequencies = np.array(frequencies)
-    snapshots = np.array(snapshots)
+def analyze_hops(occupancy, scan_period, bins=50, timestamps=None):
+    """
+    Detects hops as changes of the occupied frequencies between consecutive non-empty snapshots,
+    and measures the dwell time between two hops with run-length encoding.
     
-    # Analyze FHSS: Find carriers by detecting peaks above the dBm threshold
-    carriers_by_snapshot = defaultdict(list)
-    for idx, snapshot in enumerate(snapshots):
-        carrier_indices = np.where(snapshot > dBm_threshold)[0]  # Find indices where dBm is above threshold
-        carrier_frequencies = frequencies[carrier_indices]  # Get corresponding frequencies
-        carriers_by_snapshot[idx] = carrier_frequencies
-
-    all_carriers = np.concatenate(list(carriers_by_snapshot.values()))
-    # Count and print the number of empty carriers_by_snapshot
-    empty_snapshots_count = sum(1 for carriers in carriers_by_snapshot.values() if len(carriers) == 0)
-    print(f"Number of empty carriers_by_snapshot: {empty_snapshots_count} snapshots: {len(snapshots)}")
-    prev_carriers = carriers_by_snapshot[0]
-    cnt_hops = 0
-    hops = []
-    for idx in range(1, len(snapshots)):
-        curr_carriers = carriers_by_snapshot[idx]
-        if (len(curr_carriers) == 0):
-            hops.append(0)
-            continue
-        
-        if not np.array_equal(prev_carriers, curr_carriers):
-            cnt_hops = cnt_hops + 1
-            hops.append(1)
-        else:
-            hops.append(1)
-
-        prev_carriers = curr_carriers
+    :param occupancy: Occupancy matrix from occupancy_matrix.
+    :param scan_period: Time between two snapshots in seconds.
+    :param bins: Number of bins of the dwell time histogram.
+    :param timestamps: Optional arrival time of every snapshot in nanoseconds. The dwell times are then measured
+                       between the arrival times of the hops, so irregular sweeps and lost snapshots are accounted
+                       for, instead of counting snapshots of scan_period.
+    :return: Dictionary with the hop count, the per-snapshot hop indicator and the dwell time distribution.
+    """
+    empty = ~occupancy.any(axis=1)
+    # Each non-empty snapshot is compared with the previous non-empty one (the first snapshot in any case)
+    compared = np.flatnonzero(~empty)
+    compared = np.concatenate(([0], compared[compared > 0]))
+    changed = np.any(occupancy[compared[1:]] != occupancy[compared[:-1]], axis=1)
+    hop_indices = compared[1:][changed]
 
-    hop_duration = len(snapshots) / cnt_hops
+    # Dwell times between consecutive hops, the runs before the first and after the last hop are incomplete
+    if timestamps is not None and len(timestamps) >= len(occupancy):
+        dwell_times = np.diff(np.asarray(timestamps)[hop_indices]) / 1e9
+    else:
+        dwell_times = np.diff(hop_indices) * scan_period
+    histogram = np.histogram(dwell_times, bins=bins) if len(dwell_times) else (np.empty(0), np.empty(0))
+    percentiles = dict(zip((10, 50, 90, 99), np.percentile(dwell_times, (10, 50, 90, 99)))) if len(dwell_times) else {}
 
     return {
-        "hop_duration": hop_duration,
-        "hops": hops
+        "hop_duration": len(occupancy) / len(hop_indices) if len(hop_indices) else np.inf,
+        "hops": (~empty[1:]).astype(int),
+        "hop_indices": hop_indices,
+        "empty_snapshots": int(np.count_nonzero(empty)),
+        "scan_period": scan_period,
+        "dwell_times": dwell_times,
+        "dwell_histogram": histogram,
+        "dwell_percentiles": percentiles
     }
 
+def read_csv_for_fhss_analysis(csv_file, dBm_threshold=-90, scan_period=None):
+    """
+    Reads the recording or CSV file, extracts snapshots, and analyzes frequency hop duration.
+    
+    :param csv_file: Path to the .rec recording or CSV file.
+    :param dBm_threshold: dBm threshold to identify a frequency as a carrier.
+    :param scan_period: Time between two snapshots in seconds, by default taken from the recording metadata.
+                        Without it, the dwell times are measured with the snapshot timestamps of the recording
+                        when it has them.
+    :return: Dictionary from analyze_hops, "hop_duration" is the average number of snapshots per hop.
+    """
+    
+    # Read the recording (memory-mapped) or the CSV file
+    frequencies, snapshots = load_snapshots(csv_file)
+    timestamps = None
+    if scan_period is None:
+        timestamps = load_timestamps(csv_file)
+        scan_period = read_sweep_period(csv_file)
+    if scan_period is None:
+        print(f"No timing metadata in {csv_file}, assuming a scan period of {DEFAULT_SCAN_PERIOD} s")
+        scan_period = DEFAULT_SCAN_PERIOD
+    
+    # Analyze FHSS: Find carriers by detecting frequencies above the dBm threshold
+    analysis_results = analyze_hops(occupancy_matrix(snapshots, dBm_threshold), scan_period,
+                                    timestamps=timestamps)
+    print(f"Number of empty carriers_by_snapshot: {analysis_results['empty_snapshots']} snapshots: {len(snapshots)}")
+    return analysis_results
+
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     # Scan happens each 10.7ms
     csv_file = "recordings/outputvbw_start865000000.0_stop870000000.0_points25.csv"  # Path to the CSV file
    
     # Scan happens each 10.7ms
     # csv_file = "recordings/output200hz_start865000000.0_stop870000000.0_points25.csv"  # Path to the CSV file
 
+    if len(sys.argv) > 1:
+        csv_file = sys.argv[1]
+
     dBm_threshold = -40  # dBm threshold to detect carrier frequencies
 
     # Analyze the FHSS from the CSV file
     analysis_results = read_csv_for_fhss_analysis(csv_file, dBm_threshold)
 
-    print(f"Average Hop Duration: {analysis_results['hop_duration']*0.0107} seconds")
+    print(f"Average Hop Duration: {analysis_results['hop_duration']*analysis_results['scan_period']} seconds")
+    for percentile, dwell_time in analysis_results['dwell_percentiles'].items():
+        print(f"Dwell time p{percentile}: {dwell_time} seconds")
     
-    plt.figure(figsize=(10, 4))
+    plt.figure(figsize=(10, 8))
+    plt.subplot(2, 1, 1)
     plt.plot(analysis_results['hops'][:200], marker='o', linestyle='-', markersize=2)
     plt.title('Hops Distribution')
     plt.xlabel('Snapshot Index')
     plt.ylabel('Hop (0 or 1)')
     plt.grid(True)
+
+    counts, edges = analysis_results['dwell_histogram']
+    plt.subplot(2, 1, 2)
+    plt.bar(edges[:-1], counts, width=np.diff(edges), align='edge')
+    plt.title('Dwell Time Distribution')
+    plt.xlabel('Dwell Time (s)')
+    plt.ylabel('Number of Hops')
+    plt.grid(True)
+    plt.tight_layout()
     plt.show()
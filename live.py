@@ -0,0 +1,181 @@
+import os
+import queue
+import sys
+import threading
+import time
+import numpy as np
+from bin_to_csv import decode_snapshots
+
+# The carrier detection is shared with the offline analyzers
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fhss_analyzers"))
+from average_snaphot_analyzer import StreamingAverager, find_carriers
+
+class LiveCarrierDetector:
+    """
+    Finds carriers while scanning. The capture writer offers batches of raw snapshots; they are queued
+    without blocking (dropped and counted when the queue is full) and decoded on a separate thread,
+    which feeds a StreamingAverager and reports the carriers every `report_every` snapshots
+    and once more at the end for the snapshots after the last report.
+    """
+
+    def __init__(self, start_freq, end_freq, points, report_every=500, threshold=-40, queue_size=64):
+        """
+        :param report_every: Number of snapshots between two carrier reports.
+        :param threshold: Only values above this dBm threshold are averaged, carriers are searched
+                          above threshold/2 like in average_snaphot_analyzer.
+        :param queue_size: Number of batches waiting for analysis before new batches are dropped.
+        """
+        self.frequencies = np.linspace(start_freq, end_freq, points)
+        self.points = points
+        self.report_every = report_every
+        self.threshold = threshold
+        self.averager = StreamingAverager(points, threshold)
+        self.queue = queue.Queue(queue_size)
+        self.dropped_batches = 0
+        self.carriers = np.empty(0)
+        self.reported = 0  # Number of snapshots of the last report
+        self.thread = threading.Thread(target=self._run, name="live carrier detection", daemon=True)
+
+    def offer(self, snapshots, timestamps=None):
+        """
+        Hands a batch of raw snapshots over for analysis. Never blocks the caller.
+
+        :param snapshots: Bytes-like object of whole scanraw snapshots, copied before returning.
+        :param timestamps: Arrival times of the snapshots, not used.
+        """
+        try:
+            self.queue.put_nowait(bytes(snapshots))
+        except queue.Full:
+            self.dropped_batches += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        next_report = self.report_every
+        while (data := self.queue.get()) is not None:
+            self.averager.update(decode_snapshots(data, self.points))
+            if self.averager.num_snapshots >= next_report:
+                self.report()
+                next_report = self.averager.num_snapshots + self.report_every
+        # The final report, unless the last batch was just reported
+        self.report()
+
+    def report(self):
+        if self.averager.num_snapshots == self.reported:
+            return
+        self.reported = self.averager.num_snapshots
+        self.carriers, num_carriers = find_carriers(self.frequencies, self.averager.average(), self.threshold / 2)
+        print(f"[{self.averager.num_snapshots} snapshots] Number of carriers: {num_carriers} "
+              f"Carrier frequencies: {self.carriers} (dropped batches {self.dropped_batches})")
+
+class LiveSpectrumView:
+    """
+    Live plot of the latest spectrum and a scrolling waterfall while scanning.
+    The capture writer offers batches of raw snapshots into a buffer holding at most `rows` snapshots;
+    when rendering falls behind, the oldest snapshots are dropped and counted instead of queued,
+    so the capture never waits for the display. Rendering runs on the main thread (render is called
+    by CaptureEngine.run), at most max_fps times per second, and redraws only the changed artists (blitting).
+    """
+
+    def __init__(self, start_freq, end_freq, points, rows=200, max_fps=20, dbm_range=(-120, -20)):
+        """
+        :param rows: Number of snapshots shown in the waterfall.
+        :param max_fps: Maximum number of frames drawn per second.
+        :param dbm_range: Range of the dBm axis and of the waterfall colors.
+        """
+        self.frequencies = np.linspace(start_freq, end_freq, points)
+        self.points = points
+        self.rows = rows
+        self.interval = 1 / max_fps
+        self.dbm_range = dbm_range
+        self.waterfall = np.full((rows, points), float(dbm_range[0]))  # Ring of the newest snapshots
+        self.next_row = 0
+        self.snapshot_size = points * 3 + 2
+        self.lock = threading.Lock()
+        self.pending = bytearray()  # Snapshots offered since the last frame
+        self.dropped_snapshots = 0
+        self.rendered_frames = 0
+        self.last_frame = 0.0
+        self.figure = None
+
+    def offer(self, snapshots, timestamps=None):
+        """
+        Hands a batch of raw snapshots over for display without waiting for the rendering.
+
+        :param snapshots: Bytes-like object of whole scanraw snapshots, copied before returning.
+        :param timestamps: Arrival times of the snapshots, not used.
+        """
+        # The renderer holds the lock only to copy the buffer, and the ring buffer decouples
+        # this writer thread from the serial reader
+        with self.lock:
+            self.pending += snapshots
+            excess = len(self.pending) - self.rows * self.snapshot_size
+            if excess > 0:
+                del self.pending[:excess]
+                self.dropped_snapshots += excess // self.snapshot_size
+
+    def _open(self):
+        import matplotlib.pyplot as plt
+
+        self.figure, (spectrum_axes, waterfall_axes) = plt.subplots(2, 1, figsize=(10, 8))
+        (self.line,) = spectrum_axes.plot(self.frequencies, np.full(self.points, np.nan), animated=True)
+        spectrum_axes.set_ylim(*self.dbm_range)
+        spectrum_axes.set_xlabel("Frequency (Hz)")
+        spectrum_axes.set_ylabel("dBm")
+        spectrum_axes.grid(True)
+        self.image = waterfall_axes.imshow(self.waterfall, aspect='auto', interpolation='nearest', cmap='viridis',
+                                           vmin=self.dbm_range[0], vmax=self.dbm_range[1], animated=True,
+                                           extent=(self.frequencies[0], self.frequencies[-1], self.rows, 0))
+        waterfall_axes.set_xlabel("Frequency (Hz)")
+        waterfall_axes.set_ylabel("Snapshots ago")
+        self.figure.tight_layout()
+        plt.show(block=False)
+        self.figure.canvas.draw()
+        self.background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+
+    def render(self):
+        """
+        Draws the pending snapshots if the frame interval has passed. Called repeatedly from the main thread.
+        """
+        now = time.monotonic()
+        if now - self.last_frame < self.interval:
+            return
+        with self.lock:
+            data = bytes(self.pending)
+            self.pending.clear()
+        if not data:
+            return
+        self.last_frame = now
+
+        snapshots = decode_snapshots(data, self.points)
+        if not len(snapshots):
+            return
+        rows = (self.next_row + np.arange(len(snapshots))) % self.rows
+        self.waterfall[rows] = snapshots
+        self.next_row = (rows[-1] + 1) % self.rows
+
+        if self.figure is None:
+            self._open()
+        import matplotlib.pyplot as plt
+        if not plt.fignum_exists(self.figure.number):
+            return  # The window was closed, keep capturing without display
+
+        # Newest snapshot on top
+        order = (self.next_row - 1 - np.arange(self.rows)) % self.rows
+        self.line.set_ydata(snapshots[-1])
+        self.image.set_data(self.waterfall[order])
+        canvas = self.figure.canvas
+        canvas.restore_region(self.background)
+        self.line.axes.draw_artist(self.line)
+        self.image.axes.draw_artist(self.image)
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+        self.rendered_frames += 1
+
+    def report(self):
+        print(f"Live view: {self.rendered_frames} frames rendered, {self.dropped_snapshots} snapshots dropped")
@@ -0,0 +1,208 @@
+import bisect
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket counts everything slower
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Prefix of the metric names in the Prometheus text format
+PROMETHEUS_PREFIX = "tinysa_"
+
+class Histogram:
+    """
+    Fixed-bucket histogram, like a Prometheus histogram. Observing a value is one bisect and three additions.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: Sorted upper bounds of the buckets.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_many(self, values):
+        """
+        Observes an array of values at once, e.g. the sweep intervals of a batch of snapshots.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        counts = np.bincount(np.searchsorted(self.buckets, values), minlength=len(self.counts))
+        self.counts = [old + int(new) for old, new in zip(self.counts, counts)]
+        self.sum += float(values.sum())
+        self.count += len(values)
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket holding it (inf for the last bucket).
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+class Metrics:
+    """
+    Counters, gauges and histograms of one capture (one device), cheap enough to stay enabled.
+    Updates take no lock: each metric is updated by a single thread (the serial reader, the file writer
+    or the converter), and the exporter only copies the values.
+    """
+
+    def __init__(self, **labels):
+        """
+        :param labels: Labels of every exported value, e.g. device="/dev/ttyACM0".
+        """
+        self.labels = labels
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        """
+        Returns the histogram called name, created on first use.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        return histogram
+
+    def observe(self, name, value):
+        self.histogram(name).observe(value)
+
+    def snapshot(self):
+        """
+        :return: Dictionary with copies of the labels, counters, gauges and histograms.
+        """
+        return {
+            "labels": dict(self.labels),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "histograms": {name: histogram.to_dict() for name, histogram in list(self.histograms.items())}
+        }
+
+def _prometheus_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+class MetricsExporter:
+    """
+    Flushes Metrics to a file from a background thread every `interval` seconds, and once more on stop().
+    A .prom file is rewritten in the Prometheus text format (atomically, for the node exporter textfile
+    collector). Any other file gets one JSON line per flush and registry appended.
+    Each flush also exports the per-second rate of every counter since the previous flush,
+    e.g. serial_bytes_total gives serial_bytes_per_second.
+    """
+
+    def __init__(self, metrics, filename, interval=10.0):
+        """
+        :param metrics: A Metrics instance or a list of them, e.g. one per device.
+        :param filename: Path of the metrics file, ending with .prom for the Prometheus text format.
+        :param interval: Time between two flushes in seconds.
+        """
+        self.registries = [metrics] if isinstance(metrics, Metrics) else list(metrics)
+        self.filename = filename
+        self.interval = interval
+        self.prometheus = filename.endswith(".prom")
+        self.previous = [({}, time.monotonic()) for _ in self.registries]
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics exporter", daemon=True)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.flush()
+
+    def _rates(self, index, counters, now):
+        previous, last_flush = self.previous[index]
+        self.previous[index] = (counters, now)
+        elapsed = now - last_flush
+        return {name.removesuffix("_total") + "_per_second": (value - previous.get(name, 0)) / elapsed
+                for name, value in counters.items()} if elapsed > 0 else {}
+
+    def flush(self):
+        """
+        Writes the current values of all registries.
+        """
+        now = time.monotonic()
+        snapshots = []
+        for index, metrics in enumerate(self.registries):
+            snapshot = metrics.snapshot()
+            snapshot["rates"] = self._rates(index, snapshot["counters"], now)
+            snapshots.append(snapshot)
+
+        if self.prometheus:
+            temporary = self.filename + ".tmp"
+            with open(temporary, "w") as f:
+                f.write(self._prometheus_text(snapshots))
+            os.replace(temporary, self.filename)
+        else:
+            with open(self.filename, "a") as f:
+                for snapshot in snapshots:
+                    f.write(json.dumps(dict(time=time.time(), **snapshot)) + "\n")
+
+    def _prometheus_text(self, snapshots):
+        families = {}  # Samples grouped by metric name, each name has one TYPE line
+        for snapshot in snapshots:
+            labels = snapshot["labels"]
+            for name, value in snapshot["counters"].items():
+                families.setdefault((name, "counter"), []).append(f"{_prometheus_labels(labels)} {value}")
+            for name, value in list(snapshot["gauges"].items()) + list(snapshot["rates"].items()):
+                families.setdefault((name, "gauge"), []).append(f"{_prometheus_labels(labels)} {value}")
+            for name, histogram in snapshot["histograms"].items():
+                samples = families.setdefault((name, "histogram"), [])
+                total = 0
+                for bound, count in zip(histogram["buckets"] + ["+Inf"], histogram["counts"]):
+                    total += count
+                    samples.append(f"_bucket{_prometheus_labels(labels, le=bound)} {total}")
+                samples.append(f"_sum{_prometheus_labels(labels)} {histogram['sum']}")
+                samples.append(f"_count{_prometheus_labels(labels)} {histogram['count']}")
+
+        lines = []
+        for (name, kind), samples in families.items():
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} {kind}")
+            lines += [f"{PROMETHEUS_PREFIX}{name}{sample}" for sample in samples]
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the background thread and writes the final values.
+        """
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
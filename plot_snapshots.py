@@ -1,40 +1,21 @@
-import csv
 import matplotlib.pyplot as plt
-import numpy as np
+from recording import load_snapshots
 
 def read_csv_and_plot(csv_file, num_snapshots):
     """
-    Reads the CSV file, extracts the specified number of snapshots, and plots them.
+    Reads the recording or CSV file, extracts the specified number of snapshots, and plots them.
     
-    :param csv_file: Path to the CSV file.
+    :param csv_file: Path to the .rec recording or CSV file.
     :param num_snapshots: Number of snapshots to plot.
     """
     
-    frequencies = []
-    snapshots = []
+    # Read only the snapshots to plot from the recording or the CSV file
+    frequencies, snapshots = load_snapshots(csv_file, num_snapshots)
 
-    with open(csv_file, 'r') as f:
-        reader = csv.reader(f)
-        header = next(reader)  # First row is the header with frequencies
-        
-        # Extract frequencies from the header (ignoring 'Snapshot' label)
-        frequencies = [float(freq.split()[0]) for freq in header[1:]]
-        
-        # Read the snapshot data
-        for row in reader:
-            if len(snapshots) < num_snapshots:
-                snapshots.append([float(dbm) for dbm in row[1:]])  # Collect dBm values for each snapshot
-            else:
-                break  # Stop reading if the required number of snapshots is read
-
-    if not snapshots:
+    if len(snapshots) == 0:
         print("No snapshots available for plotting.")
         return
 
-    # Convert frequencies and snapshots to NumPy arrays for easier plotting
-    frequencies = np.array(frequencies)
-    snapshots = np.array(snapshots)
-
     # Plot the snapshots
     plt.figure(figsize=(10, 6))
     for idx, snapshot in enumerate(snapshots):
@@ -0,0 +1,524 @@
+import csv
+import itertools
+import json
+import logging
+import os
+import struct
+import tempfile
+import numpy as np
+
+# Recording layout: MAGIC, uint32 length of the JSON metadata, the metadata padded with spaces
+# to HEADER_SIZE bytes, an optional float64 frequency axis (when the metadata has "frequency_axis"),
+# then the snapshot matrix (one row of `points` values per snapshot).
+MAGIC = b"TSAREC01"
+HEADER_SIZE = 4096
+RECORDING_EXTENSION = ".rec"
+# Sidecar cache of a CSV file, stored as a recording next to it
+CACHE_SUFFIX = ".cache" + RECORDING_EXTENSION
+# Sidecar of a capture or recording file with the arrival time of every snapshot,
+# as little-endian int64 time.monotonic_ns() values
+TIMESTAMPS_SUFFIX = ".ts"
+# Extension of the compressed recordings of compressed_recording.py
+COMPRESSED_EXTENSION = ".crec"
+# Sidecar of a merged recording with the index of the source (device or segment) of every snapshot, as uint16
+SOURCES_SUFFIX = ".src"
+# Sidecar of a segmented recording describing its sources (JSON list indexed by the SOURCES_SUFFIX values)
+SOURCE_TABLE_SUFFIX = ".src.json"
+# Size of the float64 batches of snapshots processed at once, so memory stays bounded at any number of points
+BATCH_BYTES = 64 << 20
+# Raw scanraw values are int16 codes, dBm = code / CODES_PER_DB + CODE_DBM_OFFSET (TinySA Ultra adjustment)
+CODES_PER_DB = 32.0
+CODE_DBM_OFFSET = -174
+# Code stored for the values a stitched recording of raw values has no measurement for, read back as NaN
+MISSING_CODE = -32768
+
+def _pack_header(metadata, magic=MAGIC):
+    header = json.dumps(metadata).encode()
+    if len(header) > HEADER_SIZE - len(magic) - 4:
+        raise ValueError("Recording metadata does not fit into the header")
+    return (magic + struct.pack("<I", len(header)) + header).ljust(HEADER_SIZE, b" ")
+
+def read_header(filename, magic=MAGIC):
+    """
+    Reads the metadata header of a recording.
+
+    :param filename: Path to the recording file.
+    :param magic: Magic bytes of the expected recording format.
+    :return: Dictionary with start_freq, stop_freq, points, dtype, sweep settings and capture duration.
+    """
+    with open(filename, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not header.startswith(magic):
+        raise ValueError(f"{filename} is not a tinySA recording")
+    (length,) = struct.unpack_from("<I", header, len(magic))
+    return json.loads(header[len(magic) + 4:len(magic) + 4 + length])
+
+def batch_rows(points, batch_bytes=BATCH_BYTES):
+    """
+    Returns the number of snapshots of `points` float64 values that fit in batch_bytes.
+    """
+    return max(1, batch_bytes // (points * 8))
+
+def dbm_to_code(dbm):
+    """
+    Converts dBm values to code units, e.g. a threshold: code > dbm_to_code(threshold) when dBm > threshold.
+    """
+    return (np.asarray(dbm, dtype=np.float64) - CODE_DBM_OFFSET) * CODES_PER_DB
+
+def dbm_to_codes(snapshots):
+    """
+    Converts dBm values back to the raw codes they were decoded from.
+
+    :return: Array of int16 codes, None if some values are not exactly code / 32 - 174 (e.g. NaN or edited values).
+    """
+    codes = np.rint(dbm_to_code(snapshots))
+    if not np.all((codes >= -32768) & (codes <= 32767)) or \
+            not np.array_equal(codes / CODES_PER_DB + CODE_DBM_OFFSET, snapshots):
+        return None
+    return codes.astype(np.int16)
+
+class DbmSnapshots:
+    """
+    Read-only dBm view of raw int16 snapshot codes, e.g. a memory-mapped recording of codes.
+    Indexing and slicing convert only the selected snapshots to float64 dBm, so the snapshots stay
+    at a quarter of the float64 size on disk and in memory. Thresholds can be applied to `codes` directly
+    (see threshold_operands).
+    """
+
+    ndim = 2
+    dtype = np.dtype(np.float64)
+
+    def __init__(self, codes, missing_code=None):
+        """
+        :param codes: Array of raw int16 values (each row is a snapshot).
+        :param missing_code: Code of the values without a measurement, converted to NaN.
+        """
+        self.codes = codes
+        self.missing_code = missing_code
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        codes = np.asarray(self.codes[key])
+        snapshots = codes.astype(np.float64)
+        snapshots /= CODES_PER_DB  # In place, a batch is converted without temporaries
+        snapshots += CODE_DBM_OFFSET
+        if self.missing_code is not None:
+            snapshots[codes == self.missing_code] = np.nan
+        return snapshots[()] if snapshots.ndim == 0 else snapshots
+
+    def __iter__(self):
+        for start in range(0, len(self.codes), 4096):
+            yield from self[start:start + 4096]
+
+    def __array__(self, dtype=None, copy=None):
+        snapshots = self[:]
+        return snapshots if dtype is None else snapshots.astype(dtype)
+
+def first_snapshots(snapshots, count):
+    """
+    Returns the first `count` snapshots (all of them if None) without loading them:
+    a memory map stays a memory map and a DbmSnapshots stays a view of the codes.
+    """
+    if count is None:
+        return snapshots
+    if isinstance(snapshots, DbmSnapshots):
+        return DbmSnapshots(snapshots.codes[:count], snapshots.missing_code)
+    return snapshots[:count]
+
+def threshold_operands(snapshots, dbm_threshold):
+    """
+    Returns the values and threshold to compare for `snapshots > dbm_threshold`: the raw codes and the threshold
+    in code units for a DbmSnapshots, so no float64 copy is made, the snapshots and the threshold otherwise.
+    """
+    if isinstance(snapshots, DbmSnapshots):
+        return snapshots.codes, dbm_to_code(dbm_threshold)
+    return snapshots, dbm_threshold
+
+class RecordingWriter:
+    """
+    Writes snapshots to a recording file that can be memory-mapped by the analyzers.
+    The metadata header is rewritten on close, so the capture duration can be added at the end.
+    """
+
+    def __init__(self, filename, start_freq, stop_freq, points, dtype=np.float64, frequencies=None, codes=False,
+                 **metadata):
+        """
+        :param filename: Path to the recording file.
+        :param start_freq: Start frequency in Hz.
+        :param stop_freq: Stop frequency in Hz.
+        :param points: Number of points in each scan.
+        :param dtype: Type of the stored values, float64 for dBm values (e.g. with NaN in merged recordings).
+        :param codes: The values are raw int16 codes, which open_recording returns as a DbmSnapshots view.
+        :param frequencies: Optional frequency of every point, stored when the points are not evenly spaced
+                            from start_freq to stop_freq.
+        :param metadata: Sweep settings and other values stored in the header.
+        """
+        self.filename = filename
+        self.metadata = dict(metadata, start_freq=start_freq, stop_freq=stop_freq, points=points,
+                             dtype=np.dtype(dtype).str)
+        if frequencies is not None:
+            self.metadata["frequency_axis"] = True
+        if codes:
+            self.metadata["codes"] = True
+        self.dtype = np.dtype(dtype)
+        self.points = points
+        self.snapshots = 0
+        self.file = open(filename, "wb")
+        self.file.write(_pack_header(self.metadata))
+        self.timestamps_file = None
+        self.sources_file = None
+        if frequencies is not None:
+            self.file.write(np.asarray(frequencies, dtype="<f8").reshape(points).data)
+
+    def write(self, snapshots, timestamps=None, sources=None):
+        """
+        Appends snapshots to the recording.
+
+        :param snapshots: Array of snapshot values (each row is a snapshot).
+        :param timestamps: Optional arrival times of the snapshots in nanoseconds, stored in the
+                           filename + TIMESTAMPS_SUFFIX sidecar. Give them for every write or never.
+        :param sources: Optional index of the source of every snapshot, stored in the
+                        filename + SOURCES_SUFFIX sidecar. Give them for every write or never.
+        """
+        snapshots = np.ascontiguousarray(snapshots, dtype=self.dtype).reshape(-1, self.points)
+        self.file.write(snapshots.data)
+        self.snapshots += len(snapshots)
+        if timestamps is not None:
+            if self.timestamps_file is None:
+                self.timestamps_file = open(self.filename + TIMESTAMPS_SUFFIX, "wb")
+            self.timestamps_file.write(np.asarray(timestamps, dtype="<i8").data)
+        if sources is not None:
+            if self.sources_file is None:
+                self.sources_file = open(self.filename + SOURCES_SUFFIX, "wb")
+            self.sources_file.write(np.asarray(sources, dtype="<u2").data)
+
+    def close(self, **metadata):
+        """
+        Updates the header with the final metadata and closes the file.
+
+        :param metadata: Values known only at the end of the capture, e.g. capture_duration_ms.
+        """
+        if self.file.closed:
+            return
+        self.metadata.update(metadata)
+        self.file.seek(0)
+        self.file.write(_pack_header(self.metadata))
+        self.file.close()
+        if self.timestamps_file is not None:
+            self.timestamps_file.close()
+        if self.sources_file is not None:
+            self.sources_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_recording(filename, mode="r", raw=False):
+    """
+    Memory-maps a recording. Only the pages of the snapshots that are accessed are read from disk.
+
+    :param filename: Path to the recording file.
+    :param mode: np.memmap mode, "r" for read-only access.
+    :param raw: Return the int16 codes of a recording of raw values instead of a DbmSnapshots view of them.
+    :return: A tuple of (metadata, frequencies, snapshots) where snapshots is a np.memmap,
+             or a DbmSnapshots of the memmap for a recording of raw values.
+    """
+    metadata = read_header(filename)
+    dtype = np.dtype(metadata["dtype"])
+    points = metadata["points"]
+    offset = HEADER_SIZE
+    if metadata.get("frequency_axis"):
+        frequencies = np.fromfile(filename, dtype="<f8", count=points, offset=HEADER_SIZE)
+        offset += points * 8
+    else:
+        frequencies = np.linspace(metadata["start_freq"], metadata["stop_freq"], points)
+
+    # The snapshot count comes from the file size, so interrupted captures can still be opened
+    count = (os.path.getsize(filename) - offset) // (dtype.itemsize * points)
+    if count == 0:
+        snapshots = np.empty((0, points), dtype=dtype)
+    else:
+        snapshots = np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=(count, points))
+    if metadata.get("codes") and not raw:
+        snapshots = DbmSnapshots(snapshots, metadata.get("missing_code"))
+    return metadata, frequencies, snapshots
+
+def read_sweep_period(filename):
+    """
+    Returns the average time between two snapshots of a recording, from its snapshot timestamps
+    or else from its capture duration.
+
+    :param filename: Path to a .rec or .crec recording or a CSV file.
+    :return: Sweep period in seconds, None when the file has no timing metadata.
+    """
+    if filename.endswith(COMPRESSED_EXTENSION):
+        from compressed_recording import CompressedRecording
+        with CompressedRecording(filename) as snapshots:
+            metadata, timestamps = snapshots.metadata, snapshots.timestamps()
+    elif filename.endswith(RECORDING_EXTENSION):
+        timestamps = read_timestamps(filename)
+        metadata, _, snapshots = open_recording(filename)
+    else:
+        return None
+    if timestamps is not None and len(timestamps) > 1:
+        return sweep_interval_stats(timestamps)["mean"] / 1000
+    if not metadata.get("capture_duration_ms") or not len(snapshots):
+        return None
+    return metadata["capture_duration_ms"] / 1000 / len(snapshots)
+
+def read_timestamps(filename):
+    """
+    Memory-maps the snapshot arrival times saved next to a capture or recording file.
+
+    :param filename: Path to the .bin capture or .rec recording.
+    :return: Array of time.monotonic_ns() values, one per snapshot, None if there is no timestamp file.
+    """
+    timestamps_file = filename + TIMESTAMPS_SUFFIX
+    if not os.path.exists(timestamps_file):
+        return None
+    if os.path.getsize(timestamps_file) == 0:
+        return np.empty(0, dtype="<i8")
+    return np.memmap(timestamps_file, dtype="<i8", mode="r")
+
+def read_sources(filename):
+    """
+    Memory-maps the source index of every snapshot of a merged recording.
+
+    :param filename: Path to the .rec recording.
+    :return: Array of indices into the source table (see read_source_table), None if there is no source file.
+    """
+    sources_file = filename + SOURCES_SUFFIX
+    if not os.path.exists(sources_file):
+        return None
+    if os.path.getsize(sources_file) == 0:
+        return np.empty(0, dtype="<u2")
+    return np.memmap(sources_file, dtype="<u2", mode="r")
+
+def write_source_table(filename, sources):
+    """
+    Writes the description of the sources of a recording to its SOURCE_TABLE_SUFFIX sidecar.
+
+    :param sources: List of dictionaries, one per source index.
+    """
+    with open(filename + SOURCE_TABLE_SUFFIX, "w") as f:
+        json.dump(sources, f, indent=1)
+
+def read_source_table(filename):
+    """
+    Returns the description of the sources of a recording, from its SOURCE_TABLE_SUFFIX sidecar
+    or from the "sources" list of its metadata (merged recordings).
+
+    :return: List of dictionaries, one per source index, None if the recording has none.
+    """
+    try:
+        with open(filename + SOURCE_TABLE_SUFFIX) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return read_header(filename).get("sources")
+
+def merge_recordings(output_file, recordings, chunk_rows=4096, **metadata):
+    """
+    Merges recordings with snapshot timestamps (e.g. one per device) into one recording ordered by time.
+    The frequency axis of the merged recording is the union of the source axes; each snapshot only fills
+    the columns of its own source, the other columns are NaN. The source of every snapshot is stored in
+    the SOURCES_SUFFIX sidecar and described by the "sources" list of the metadata.
+
+    :param output_file: Path to the merged recording.
+    :param recordings: Paths to the source recordings, each with a TIMESTAMPS_SUFFIX sidecar.
+    :param chunk_rows: Number of merged snapshots written at once.
+    :param metadata: Values stored in the header of the merged recording.
+    :return: Number of snapshots in the merged recording.
+    """
+    opened = [open_recording(recording) for recording in recordings]
+    timestamps = []
+    for recording, (_, _, snapshots) in zip(recordings, opened):
+        times = read_timestamps(recording)
+        if times is None:
+            raise ValueError(f"{recording} has no snapshot timestamps")
+        timestamps.append(times[:len(snapshots)])
+
+    frequencies = np.unique(np.concatenate([frequencies for _, frequencies, _ in opened]))
+    columns = [np.searchsorted(frequencies, source_frequencies) for _, source_frequencies, _ in opened]
+    counts = [len(times) for times in timestamps]
+    times = np.concatenate(timestamps)
+    sources = np.repeat(np.arange(len(recordings)), counts)
+    rows = np.concatenate([np.arange(count) for count in counts])
+    order = np.argsort(times, kind="stable")
+
+    description = [{"file": os.path.basename(recording), "start_freq": source_metadata["start_freq"],
+                    "stop_freq": source_metadata["stop_freq"], "points": source_metadata["points"],
+                    **({"device": source_metadata["device"]} if "device" in source_metadata else {})}
+                   for recording, (source_metadata, _, _) in zip(recordings, opened)]
+    with RecordingWriter(output_file, frequencies[0], frequencies[-1], len(frequencies), frequencies=frequencies,
+                         sources=description, **metadata) as merged:
+        for start in range(0, len(order), chunk_rows):
+            chunk = order[start:start + chunk_rows]
+            block = np.full((len(chunk), len(frequencies)), np.nan)
+            for source, (_, _, snapshots) in enumerate(opened):
+                selected = np.flatnonzero(sources[chunk] == source)
+                if len(selected):
+                    block[selected[:, None], columns[source]] = snapshots[rows[chunk[selected]]]
+            merged.write(block, times[chunk], sources[chunk])
+    return merged.snapshots
+
+def sweep_interval_stats(timestamps):
+    """
+    Summarizes the sweep cadence from snapshot arrival times.
+
+    :param timestamps: Array of arrival times in nanoseconds.
+    :return: Dictionary with the mean, p50, p99 and max interval between snapshots in ms, empty if there are
+             fewer than two timestamps.
+    """
+    if len(timestamps) < 2:
+        return {}
+    intervals = np.diff(np.asarray(timestamps)) / 1e6
+    return {
+        "mean": intervals.mean(),
+        "p50": np.percentile(intervals, 50),
+        "p99": np.percentile(intervals, 99),
+        "max": intervals.max()
+    }
+
+def read_csv(csv_file, max_snapshots=None):
+    """
+    Reads a CSV file written by bin_to_csv and returns frequency and snapshot data.
+
+    :param csv_file: Path to the CSV file.
+    :param max_snapshots: Read at most this number of snapshots, all of them if None.
+    :return: A tuple of (frequencies, snapshots).
+    """
+    snapshots = []
+
+    with open(csv_file, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader)  # First row is the header with frequencies
+        frequencies = np.array([float(freq.split()[0]) for freq in header[1:]])
+
+        for row in reader:
+            if max_snapshots is not None and len(snapshots) >= max_snapshots:
+                break
+            snapshots.append([float(dbm) for dbm in row[1:]])
+
+    snapshots = np.array(snapshots)  # Convert to numpy array for easier processing
+    return frequencies, snapshots
+
+def _read_csv_chunks(f, points, chunk_rows):
+    """
+    Parses the rows of a CSV file written by bin_to_csv in chunks with the vectorized NumPy parser.
+    """
+    while True:
+        lines = list(itertools.islice(f, chunk_rows))
+        if not lines:
+            break
+        yield np.loadtxt(lines, delimiter=',', usecols=range(1, points + 1), ndmin=2)
+
+def _build_csv_cache(csv_file, cache_file, stat, chunk_rows, codes=True):
+    """
+    Builds the cache of a CSV file, with the raw int16 codes of the values when `codes` is set.
+
+    :raise ValueError: Some values are not raw codes decoded by bin_to_csv (only when `codes` is set).
+    """
+    with open(csv_file, 'r') as f:
+        header = next(csv.reader([f.readline()]))  # First row is the header with frequencies
+        frequencies = np.array([float(freq.split()[0]) for freq in header[1:]])
+        points = len(frequencies)
+
+        # Write to a temporary file of this build first, so an interrupted build never leaves a valid-looking
+        # cache and analyzers building the same cache at once never write to the same file
+        descriptor, temp_file = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(cache_file) + ".",
+                                                 dir=os.path.dirname(os.path.abspath(cache_file)))
+        os.close(descriptor)
+        try:
+            with RecordingWriter(temp_file, frequencies[0], frequencies[-1], points,
+                                 dtype=np.int16 if codes else np.float64, frequencies=frequencies, codes=codes,
+                                 source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns) as cache:
+                for snapshots in _read_csv_chunks(f, points, chunk_rows):
+                    if codes:
+                        snapshots = dbm_to_codes(snapshots)
+                        if snapshots is None:
+                            raise ValueError(f"{csv_file} has values that are not raw tinySA codes")
+                    cache.write(snapshots)
+            os.replace(temp_file, cache_file)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+
+def load_csv_cached(csv_file, chunk_rows=4096):
+    """
+    Loads a CSV file through a binary sidecar cache next to it (csv_file + CACHE_SUFFIX).
+    The cache is keyed on the size and modification time of the CSV file and rebuilt when stale.
+    It holds the raw int16 codes of the dBm values written by bin_to_csv, loaded as a DbmSnapshots view.
+
+    :param csv_file: Path to the CSV file.
+    :param chunk_rows: Number of CSV rows parsed at once when the cache is built.
+    :return: A tuple of (frequencies, snapshots) where snapshots is a memory-mapped cache.
+    """
+    cache_file = csv_file + CACHE_SUFFIX
+    stat = os.stat(csv_file)
+    try:
+        metadata, frequencies, snapshots = open_recording(cache_file)
+        if metadata.get("source_size") == stat.st_size and metadata.get("source_mtime_ns") == stat.st_mtime_ns:
+            return frequencies, snapshots
+    except (OSError, ValueError):
+        pass  # No cache yet or not readable, build it
+    # Unmap the stale cache before it is replaced, Windows cannot replace a mapped file
+    snapshots = None
+
+    try:
+        try:
+            _build_csv_cache(csv_file, cache_file, stat, chunk_rows)
+        except ValueError:
+            # Values that were edited or not written by bin_to_csv are cached as float64
+            _build_csv_cache(csv_file, cache_file, stat, chunk_rows, codes=False)
+    except OSError as e:
+        logging.warning(f"Could not write the cache {cache_file}: {e}. Reading the CSV file directly, "
+                        f"which is slow for large files.")
+        return read_csv(csv_file)
+    _, frequencies, snapshots = open_recording(cache_file)
+    return frequencies, snapshots
+
+def load_timestamps(filename):
+    """
+    Loads the snapshot arrival times of a recording, from its TIMESTAMPS_SUFFIX sidecar or from a compressed recording.
+
+    :param filename: Path to a .rec or .crec recording or a CSV file.
+    :return: Array of time.monotonic_ns() values, one per snapshot, None if the file has no timestamps.
+    """
+    if filename.endswith(COMPRESSED_EXTENSION):
+        from compressed_recording import CompressedRecording
+        with CompressedRecording(filename) as recording:
+            return recording.timestamps()
+    if filename.endswith(RECORDING_EXTENSION):
+        return read_timestamps(filename)
+    return None
+
+def load_snapshots(filename, max_snapshots=None):
+    """
+    Loads frequencies and snapshots from a recording (memory-mapped), a compressed recording
+    (decompressed chunk by chunk when sliced) or from a CSV file.
+    Whole CSV files are loaded through their sidecar cache.
+
+    :param filename: Path to a .rec or .crec recording or a .csv file.
+    :param max_snapshots: Load at most this number of snapshots, all of them if None.
+    :return: A tuple of (frequencies, snapshots).
+    """
+    if filename.endswith(RECORDING_EXTENSION):
+        _, frequencies, snapshots = open_recording(filename)
+        return frequencies, first_snapshots(snapshots, max_snapshots)
+    if filename.endswith(COMPRESSED_EXTENSION):
+        from compressed_recording import CompressedRecording  # Imports this module
+        snapshots = CompressedRecording(filename)
+        if max_snapshots is not None:
+            return snapshots.frequencies, snapshots[:max_snapshots]
+        return snapshots.frequencies, snapshots
+    if max_snapshots is None:
+        return load_csv_cached(filename)
+    return read_csv(filename, max_snapshots)
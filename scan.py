@@ -1,19 +1,28 @@
 import serial
 import os
 import time
+import numpy as np
 from serial.tools import list_ports
-from bin_to_csv import bin_to_csv
+from bin_to_csv import SNAPSHOT_END, SNAPSHOT_START, bin_to_csv, bin_to_recording, decode_snapshots
+from capture import CaptureEngine, MultiCapture
+from compressed_recording import COMPRESSED_EXTENSION, CaptureCompressor, CompressedRecording
+from metrics import Metrics, MetricsExporter
+from recording import RECORDING_EXTENSION, merge_recordings, read_timestamps, sweep_interval_stats
+from simulator import SIMULATOR_SCHEME, SimulatedTinySA
 
 VID = 0x0483 #1155
 PID = 0x5740 #22336
 
 # Get tinysa device automatically
 def getport() -> str:
-	device_list = list_ports.comports()
-	for device in device_list:
-		if device.vid == VID and device.pid == PID:
-			return device.device
-	raise OSError("device not found")
+	ports = getports()
+	if not ports:
+		raise OSError("device not found")
+	return ports[0]
+
+# Get every connected tinysa device
+def getports() -> list:
+	return [device.device for device in list_ports.comports() if device.vid == VID and device.pid == PID]
 
 # REF_LEVEL = (1<<9)
 
@@ -22,10 +31,14 @@ class tinySA:
 		self.dev = dev or getport()
 		self.serial = None
 		self.points = 101
+		self.settings = {}  # Sweep settings sent to the device, stored in recordings
 
 	def open(self):
 		if self.serial is None:
-			self.serial = serial.Serial(self.dev)
+			if self.dev.startswith(f"{SIMULATOR_SCHEME}://"):
+				self.serial = SimulatedTinySA.from_url(self.dev)
+			else:
+				self.serial = serial.Serial(self.dev)
 
 	def close(self):
 		if self.serial:
@@ -41,6 +54,7 @@ class tinySA:
 		self.open()
 		self.serial.write(f"sweep {mode}\r".encode())
 		self.serial.readline()
+		self.settings["sweep"] = mode
 
 	def spur(self, onof):
 		self.open()
@@ -50,8 +64,11 @@ class tinySA:
 			self.serial.write("spur off\r".encode())
 
 		self.serial.readline()
+		self.settings["spur"] = bool(onof)
+
 	def rbw(self, value):
 		self.send_command(f"rbw {value}\r")
+		self.settings["rbw"] = value
 
 	def abort(self, command=None):
 		if (command):
@@ -62,24 +79,86 @@ class tinySA:
 	def resume(self):
 		self.send_command("resume\r")
 
-	def scanraw(self, start_freq, end_freq, points):
+	def stop_scan(self):
 		"""
-		A generator that reads signal data from TinySA using scanraw command and yields one byte at a time.
+		Aborts a running scanraw command and drops the data that is still buffered, so another scan can start.
 		"""
+		self.abort()
+		self.resume()
+		time.sleep(0.01)  # Let the bytes that were already on their way arrive
+		self.serial.reset_input_buffer()
+
+	def scanraw_snapshots(self, start_freq, end_freq, points, mode="bytes", snapshots_per_read=50, timestamps=False, metrics=None):
+		"""
+		A generator that reads signal data from TinySA using scanraw command and yields one framed snapshot at a time.
+		The serial port is read with readinto into a preallocated buffer of snapshots_per_read snapshots.
+		:param mode: "bytes" yields a copy of each snapshot, "view" yields a memoryview into the read buffer
+		             that is only valid until the next snapshot is requested, "dbm" yields decoded dBm arrays.
+		:param snapshots_per_read: The number of snapshots requested from the serial port in one read.
+		:param timestamps: Yield (time.monotonic_ns(), snapshot) tuples. Each read then only waits for the
+		                   end of the current snapshot, so the time is taken when its closing '}' arrives.
+		                   Snapshots that were already waiting in the serial buffer are read together and
+		                   share the time of that read, so the times are per read rather than per snapshot
+		                   when the host falls behind the device.
+		:param metrics: Optional metrics.Metrics recording the bytes and snapshots read, the latency of every
+		                serial read and the snapshots that do not start with '{' and end with '}'.
+		"""
+		if mode not in ("bytes", "view", "dbm"):
+			raise ValueError(f"Unknown scanraw mode {mode}")
+
+		snapshot_size = points * 3 + 2  # '{', points * ('x', LSB, MSB), '}'
+		buffer = bytearray(snapshot_size * snapshots_per_read)
+		view = memoryview(buffer)
+		filled = 0
 
 		# Send the scanraw command to TinySA
 		self.send_command(f"scanraw {start_freq} {end_freq} {points} 3\r")
 		try:
 			while True:
-				# Read data from the serial port in chunks
-				data = self.serial.read(50*points * 3 + 2)  # Reading 50 snapshot at a time
-				
-				if not data:
+				read_started = time.perf_counter()
+				if timestamps:
+					# Read up to the end of the current snapshot, or everything that is already waiting
+					wanted = max(snapshot_size - filled % snapshot_size, self.serial.in_waiting)
+					received = self.serial.readinto(view[filled:filled + wanted])
+					arrival = time.monotonic_ns()
+				else:
+					# Read data from the serial port directly into the free part of the buffer
+					received = self.serial.readinto(view[filled:])
+
+				if metrics is not None:
+					metrics.observe("serial_read_seconds", time.perf_counter() - read_started)
+					metrics.inc("serial_reads_total")
+					metrics.inc("serial_bytes_total", received or 0)
+
+				if not received:
 					break  # Stop reading if no data is returned
-				
-				# Yield each byte from the data chunk
-				for byte in data:
-					yield byte  # Yield one byte at a time
+
+				filled += received
+				complete = filled - filled % snapshot_size
+
+				if metrics is not None and complete:
+					# Only the frame bytes are checked, the converter resynchronizes on malformed snapshots
+					metrics.inc("snapshots_read_total", complete // snapshot_size)
+					frames = np.frombuffer(buffer, np.uint8, complete).reshape(-1, snapshot_size)
+					metrics.inc("malformed_frames_total", int(np.count_nonzero(
+						(frames[:, 0] != SNAPSHOT_START) | (frames[:, -1] != SNAPSHOT_END))))
+
+				if mode == "dbm":
+					snapshots = decode_snapshots(view[:complete], points)
+					if timestamps:
+						for snapshot in snapshots:
+							yield arrival, snapshot
+					else:
+						yield from snapshots
+				else:
+					for start in range(0, complete, snapshot_size):
+						snapshot = view[start:start + snapshot_size]
+						snapshot = snapshot if mode == "view" else bytes(snapshot)
+						yield (arrival, snapshot) if timestamps else snapshot
+
+				# Move the incomplete snapshot, if any, to the start of the buffer
+				view[:filled - complete] = view[complete:filled]
+				filled -= complete
 
 		except KeyboardInterrupt:
 			print("Data reading interrupted by user.")
@@ -88,32 +167,92 @@ class tinySA:
 
 		print("Finished reading data")
 
-	def save_signal_data(self, filename, start_freq, end_freq, points, buffer_size=4096):
+	def save_signal_data(self, filename, start_freq, end_freq, points, buffer_size=65536, ring_capacity=4096, sinks=(), idle=None, compress=False, metrics=None):
 		"""
 		Capture signal data and save it to a binary file using buffered writing.
+		Serial reading and file writing run in separate threads connected by a ring buffer of snapshots.
 		:param filename: The name of the file to save the signal data.
 		:param buffer_size: The size of the buffer (in bytes) for writing to the file.
+		:param ring_capacity: The number of snapshots buffered between the serial reader and the file writer.
+		:param sinks: Non-blocking callables receiving each written batch of raw snapshots and their arrival times, e.g. LiveCarrierDetector.offer.
+		:param idle: Callable run repeatedly on this thread while capturing, e.g. LiveSpectrumView.render.
+		:param compress: Compress the capture while it runs into a compressed recording, instead of saving it to
+		                 the binary file and converting it to a recording and a CSV file.
+		:param metrics: Optional metrics.Metrics recording the capture and the conversion, see MetricsExporter.
 		"""
-		buffer = bytearray()  # Create an in-memory buffer
 		start_time = time.time() * 1000
-		with open(filename, "wb") as f:
-			for byte in self.scanraw(start_freq, end_freq, points):
-				buffer.append(byte)  # Add the chunk to the buffer
-				
-				# If the buffer exceeds the buffer_size, write it to the file
-				if len(buffer) >= buffer_size:
-					f.write(buffer)
-					buffer.clear()  # Clear the buffer after writing
-				
-			# Write any remaining data in the buffer to the file
-			if buffer:
-				f.write(buffer)
+		compressor = None
+		if compress:
+			compressor = CaptureCompressor(filename[:-4] + COMPRESSED_EXTENSION, start_freq, end_freq, points,
+										   metrics=metrics, **self.settings)
+		engine = CaptureEngine(self, filename, start_freq, end_freq, points, ring_capacity, buffer_size, sinks, metrics,
+							   compressor)
+		engine.run(idle)
+		stats = engine.stats()
+		print(f"Snapshots read {stats['snapshots_read']}, written {stats['snapshots_written']}, "
+			  f"overruns {stats['overruns']}, ring high-water mark {stats['high_water']}/{stats['capacity']}")
 		stop_time = time.time() * 1000
+		if compressor is not None:
+			compressor.close(capture_duration_ms=stop_time - start_time)
+			filename = compressor.recording.filename
 		print(f"Signal data saved to {filename}.")
-		# Remove .bin extension and add .csv extension
+		reads = metrics.histograms.get("serial_read_seconds") if metrics is not None else None
+		if reads is not None and reads.count:
+			print(f"Serial reads {reads.count}, mean {reads.sum / reads.count * 1000:.3f}ms, "
+				  f"p99 <= {reads.quantile(0.99) * 1000:g}ms, "
+				  f"malformed frames {metrics.counters.get('malformed_frames_total', 0)}")
+		if compressor is not None:
+			with CompressedRecording(filename) as recording:
+				timestamps = recording.timestamps()
+		else:
+			timestamps = read_timestamps(filename)
+		intervals = sweep_interval_stats(timestamps) if timestamps is not None else {}
+		if intervals:
+			print(f"Sweep interval mean {intervals['mean']:.3f}ms, p50 {intervals['p50']:.3f}ms, "
+				  f"p99 {intervals['p99']:.3f}ms, max {intervals['max']:.3f}ms")
+		if compressor is not None:
+			return
+		# Remove .bin extension and add .rec and .csv extensions
+		bin_to_recording(filename, filename[:-4] + RECORDING_EXTENSION, points, start_freq, end_freq,
+						 stop_time - start_time, metrics=metrics, **self.settings)
 		csvfilename = filename[:-4] + ".csv"
+		# Only the recording conversion is counted, so the converter rates are not mixed up
 		bin_to_csv(filename, csvfilename, points, start_freq, end_freq, stop_time - start_time)
 
+def save_multi_signal_data(devices, filename, bands, points, buffer_size=65536, ring_capacity=4096, metrics=None):
+	"""
+	Capture signal data from several tinySA devices at the same time, each on its own reader and writer threads.
+	Every device is saved to its own binary file and recording, then the recordings are merged by arrival time
+	into one recording with the source device of every snapshot.
+	:param devices: tinySA instances, one per device.
+	:param filename: The name of the merged binary file, the device files get a _dev<index> suffix.
+	:param bands: (start_freq, end_freq) of every device.
+	:param points: The number of points scanned by every device.
+	:param metrics: Optional list of metrics.Metrics, one per device.
+	"""
+	base = filename[:-4]
+	filenames = [f"{base}_dev{index}.bin" for index in range(len(devices))]
+	metrics = metrics or [None] * len(devices)
+	engines = [CaptureEngine(device, device_file, start_freq, end_freq, points, ring_capacity, buffer_size,
+							 metrics=device_metrics)
+			   for device, device_file, (start_freq, end_freq), device_metrics in zip(devices, filenames, bands, metrics)]
+	start_time = time.time() * 1000
+	MultiCapture(engines).run()
+	stop_time = time.time() * 1000
+
+	recordings = []
+	for device, device_file, (start_freq, end_freq), engine in zip(devices, filenames, bands, engines):
+		stats = engine.stats()
+		print(f"{device.dev}: snapshots read {stats['snapshots_read']}, written {stats['snapshots_written']}, "
+			  f"overruns {stats['overruns']}, ring high-water mark {stats['high_water']}/{stats['capacity']}")
+		recording = device_file[:-4] + RECORDING_EXTENSION
+		bin_to_recording(device_file, recording, points, start_freq, end_freq, stop_time - start_time,
+						 metrics=engine.metrics, device=device.dev, **device.settings)
+		recordings.append(recording)
+
+	snapshots = merge_recordings(base + RECORDING_EXTENSION, recordings, capture_duration_ms=stop_time - start_time)
+	print(f"Merged recording written to {base + RECORDING_EXTENSION} with {snapshots} snapshots.")
+
 if __name__ == '__main__':
 	from optparse import OptionParser
 	parser = OptionParser(usage="%prog: [options]")
@@ -141,29 +280,179 @@ if __name__ == '__main__':
 						dest="fast_scan",
 					  	action="store_true", default=False,
 					  	help="perform fast scan")
+	parser.add_option("-l", "--live",
+						dest="live",
+					  	type="int",
+					  	default=0,
+					  	help="print the detected carriers every LIVE snapshots while scanning",
+					  	metavar="LIVE")
+	parser.add_option("-t", "--threshold",
+						dest="threshold",
+					  	type="float",
+					  	default=-40,
+					  	help="dBm threshold for averaging in live carrier detection (carriers are searched above half of it, use -100 with sim://) and for segment occupancy",
+					  	metavar="THRESHOLD")
+	parser.add_option("-v", "--view",
+						dest="view",
+					  	action="store_true", default=False,
+					  	help="show the latest spectrum and a waterfall while scanning")
+	parser.add_option("-d", "--device",
+						dest="device",
+					  	help="serial port of the tinySA, or sim://?rate=200 for a simulated one (first tinySA found by default)",
+					  	metavar="DEVICE")
+	parser.add_option("-a", "--all-devices",
+						dest="all_devices",
+					  	action="store_true", default=False,
+					  	help="scan with every connected tinySA at the same time, splitting START-STOP between them")
+	parser.add_option("-B", "--band",
+						dest="bands",
+					  	action="append", default=[],
+					  	help="band START:STOP of the next device when scanning with all devices, can be repeated",
+					  	metavar="BAND")
+	parser.add_option("-g", "--segment-span",
+						dest="segment_span",
+					  	type="float",
+					  	default=0,
+					  	help="split START-STOP into segments of SPAN Hz with POINTS points each and sweep busy segments more often",
+					  	metavar="SPAN")
+	parser.add_option("-G", "--segment",
+						dest="segments",
+					  	action="append", default=[],
+					  	help="segment START:STOP:POINTS[:RBW[:PRIORITY]] to sweep with the scheduler, can be repeated",
+					  	metavar="SEGMENT")
+	parser.add_option("-z", "--compress",
+						dest="compress",
+					  	action="store_true", default=False,
+					  	help="save a compressed recording (" + COMPRESSED_EXTENSION + ") instead of a recording and a CSV file")
+	parser.add_option("-b", "--bus",
+						dest="bus",
+					  	help="publish the decoded snapshots on a shared memory bus called NAME, which other processes can read (snapshot_bus.py)",
+					  	metavar="NAME")
+	parser.add_option("-m", "--metrics",
+						dest="metrics",
+					  	help="write capture metrics to FILE every METRICS_INTERVAL seconds, in the Prometheus text format if FILE ends with .prom, as JSON lines otherwise",
+					  	metavar="FILE")
+	parser.add_option("-M", "--metrics-interval",
+						dest="metrics_interval",
+					  	type="float",
+					  	default=10,
+					  	help="seconds between two writes of the metrics file",
+					  	metavar="METRICS_INTERVAL")
 
 	(opt, args) = parser.parse_args()
 
-	nv = tinySA(getport())
+	if opt.all_devices:
+		devices = [tinySA(port) for port in getports()]
+		if not devices:
+			raise OSError("device not found")
+		if opt.bands:
+			if len(opt.bands) != len(devices):
+				parser.error(f"{len(opt.bands)} bands given for {len(devices)} devices")
+			bands = [tuple(float(freq) for freq in band.split(":")) for band in opt.bands]
+		else:
+			edges = [opt.start + (opt.stop - opt.start) * index / len(devices) for index in range(len(devices) + 1)]
+			bands = list(zip(edges[:-1], edges[1:]))
+		recordings_dir = 'recordings'
+		if not os.path.exists(recordings_dir):
+			os.makedirs(recordings_dir)
+		file_name = os.path.join(recordings_dir, f"{opt.save}_multi{len(devices)}_points{opt.points}.bin")
+		for device, (start, stop) in zip(devices, bands):
+			print(f"{device.dev}: start frequency {start}, stop frequency {stop}, number of points {opt.points}")
+			device.abort("on")
+			if (opt.fast_scan):
+				device.spur(False)
+				device.sweep("fast")
+				device.rbw(300)
+		metrics = [Metrics(device=device.dev) for device in devices] if opt.metrics else None
+		exporter = MetricsExporter(metrics, opt.metrics, opt.metrics_interval).start() if opt.metrics else None
+		print("Press Ctrl+C to stop scanning")
+		save_multi_signal_data(devices, file_name, bands, opt.points, metrics=metrics)
+		if exporter:
+			exporter.stop()
+		print("Scanning finished")
+	elif opt.segment_span or opt.segments:
+		from sweep_scheduler import Segment, SweepScheduler, split_band
+		if opt.segments:
+			segments = []
+			for spec in opt.segments:
+				values = spec.split(":")
+				segments.append(Segment(float(values[0]), float(values[1]), int(values[2]),
+										float(values[3]) if len(values) > 3 and values[3] else None,
+										float(values[4]) if len(values) > 4 else 1.0))
+		else:
+			segments = split_band(opt.start, opt.stop, opt.segment_span, opt.points)
+		recordings_dir = 'recordings'
+		if not os.path.exists(recordings_dir):
+			os.makedirs(recordings_dir)
+		file_name = os.path.join(recordings_dir, f"{opt.save}_segments{len(segments)}{RECORDING_EXTENSION}")
+		nv = tinySA(opt.device or getport())
+		nv.abort("on")
+		if (opt.fast_scan):
+			nv.spur(False)
+			nv.sweep("fast")
+			nv.rbw(300)
+		metrics = Metrics(device=nv.dev) if opt.metrics else None
+		exporter = MetricsExporter(metrics, opt.metrics, opt.metrics_interval).start() if opt.metrics else None
+		scheduler = SweepScheduler(nv, segments, opt.threshold, metrics=metrics)
+		print(f"Sweeping {len(segments)} segments, press Ctrl+C to stop scanning")
+		snapshots = scheduler.record(file_name)
+		print(f"Recording written to {file_name} with {snapshots} snapshots.")
+		if exporter:
+			exporter.stop()
+		print("Scanning finished")
+	else:
+		nv = tinySA(opt.device or getport())
 
-	print("Scan scanning")
-	print(f"Start frequency {opt.start}")
-	print(f"Stop frequency {opt.stop}")
-	print(f"Number of points {opt.points}")
-	# Create recordings directory if it doesn't exist
-	recordings_dir = 'recordings'
-	if not os.path.exists(recordings_dir):
-		os.makedirs(recordings_dir)
+		print("Scan scanning")
+		print(f"Start frequency {opt.start}")
+		print(f"Stop frequency {opt.stop}")
+		print(f"Number of points {opt.points}")
+		# Create recordings directory if it doesn't exist
+		recordings_dir = 'recordings'
+		if not os.path.exists(recordings_dir):
+			os.makedirs(recordings_dir)
 	
-	file_name = os.path.join(recordings_dir, f"{opt.save}_start{opt.start}_stop{opt.stop}_points{opt.points}.bin")
-	# Enable abort
-	nv.abort("on")
-	if (opt.fast_scan):
-		print("Fast scanning")
-		nv.spur(False)
-		nv.sweep("fast")
-		nv.rbw(300)
+		file_name = os.path.join(recordings_dir, f"{opt.save}_start{opt.start}_stop{opt.stop}_points{opt.points}.bin")
+		# Enable abort
+		nv.abort("on")
+		if (opt.fast_scan):
+			print("Fast scanning")
+			nv.spur(False)
+			nv.sweep("fast")
+			nv.rbw(300)
 	
-	print("Press Ctrl+C to stop scanning")
-	nv.save_signal_data(file_name, opt.start, opt.stop, opt.points)
-	print("Scanning finished")
\ No newline at end of file
+		sinks = []
+		if opt.live:
+			from live import LiveCarrierDetector
+			detector = LiveCarrierDetector(opt.start, opt.stop, opt.points, opt.live, opt.threshold)
+			detector.start()
+			sinks.append(detector.offer)
+		view = None
+		if opt.view:
+			from live import LiveSpectrumView
+			view = LiveSpectrumView(opt.start, opt.stop, opt.points)
+			sinks.append(view.offer)
+		bus = None
+		if opt.bus:
+			from snapshot_bus import SnapshotBus
+			bus = SnapshotBus(opt.bus, opt.start, opt.stop, opt.points)
+			sinks.append(bus.offer)
+			print(f"Publishing snapshots on the shared memory bus {bus.name}")
+
+		print("Press Ctrl+C to stop scanning")
+		metrics = Metrics(device=nv.dev) if opt.metrics else None
+		exporter = MetricsExporter(metrics, opt.metrics, opt.metrics_interval).start() if opt.metrics else None
+		try:
+			nv.save_signal_data(file_name, opt.start, opt.stop, opt.points, sinks=sinks, idle=view and view.render,
+							  compress=opt.compress, metrics=metrics)
+		finally:
+			# Also when the conversion fails, so the threads stop and the shared memory block is removed
+			if exporter:
+				exporter.stop()
+			if opt.live:
+				detector.stop()
+			if view:
+				view.report()
+			if bus:
+				bus.close()
+		print("Scanning finished")
\ No newline at end of file
@@ -0,0 +1,259 @@
+import threading
+import time
+from urllib.parse import parse_qsl, urlparse
+import numpy as np
+from bin_to_csv import POINT_MARKER, SNAPSHOT_END, SNAPSHOT_START, snapshot_dtype
+
+# Devices named sim://?rate=200&carriers=40 are simulated, the query sets the SimulatedTinySA arguments
+SIMULATOR_SCHEME = "sim"
+
+class SimulatedTinySA:
+    """
+    Software tinySA with the serial port interface used by the tinySA class.
+    It answers abort, resume, sweep, spur and rbw, and streams scanraw snapshots at a fixed sweep rate.
+    The spectrum has a noise floor and one FHSS carrier hopping over evenly spaced channels.
+    Bytes can optionally be corrupted or dropped to exercise the resynchronizing parser.
+    """
+
+    def __init__(self, rate=200.0, carriers=40, carrier_start=None, carrier_spacing=None, hop_interval=0.02,
+                 carrier_power=-40.0, carrier_width=50e3, noise_floor=-110.0, noise=2.0,
+                 corruption=0.0, drop=0.0, max_sweeps=None, timeout=None, seed=0):
+        """
+        :param rate: Number of sweeps sent per second.
+        :param carriers: Number of FHSS channels.
+        :param carrier_start: Frequency of the first channel in Hz, 10% above the start of the first scan if None.
+        :param carrier_spacing: Distance between channels in Hz, spread over 80% of the first scan span if None.
+        :param hop_interval: Time spent on one channel in seconds.
+        :param carrier_power: Peak power of the carrier in dBm.
+        :param carrier_width: Standard deviation of the carrier shape in Hz.
+        :param noise_floor: Mean noise level in dBm.
+        :param noise: Standard deviation of the noise in dB.
+        :param corruption: Probability that a sent byte is replaced by a random byte.
+        :param drop: Probability that a sent byte is lost.
+        :param max_sweeps: Stop the scanraw stream after this number of sweeps, like an unplugged device.
+        :param timeout: Read timeout in seconds like serial.Serial, reads block until complete if None.
+        :param seed: Seed of the random generator.
+        """
+        self.rate = float(rate)
+        self.carriers = int(carriers)
+        self.carrier_start = carrier_start
+        self.carrier_spacing = carrier_spacing
+        self.hop_interval = float(hop_interval)
+        self.carrier_power = float(carrier_power)
+        self.carrier_width = float(carrier_width)
+        self.noise_floor = float(noise_floor)
+        self.noise = float(noise)
+        self.corruption = float(corruption)
+        self.drop = float(drop)
+        self.max_sweeps = None if max_sweeps is None else int(max_sweeps)
+        self.timeout = timeout
+        self.rng = np.random.default_rng(int(seed))
+        self.hops = self.rng.permutation(self.carriers)  # Hop sequence over the channels
+        self.settings = {}
+        self.output = bytearray()
+        self.scan = None  # Frequencies of the running scanraw command
+        self.started = 0.0
+        self.sweeps = 0
+        self.condition = threading.Condition()
+        self.cancelled = False
+        self.is_open = True
+
+    @classmethod
+    def from_url(cls, url):
+        """
+        Creates a simulator from a sim://?name=value&... URL, the values are SimulatedTinySA arguments.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != SIMULATOR_SCHEME:
+            raise ValueError(f"{url} is not a simulated device")
+        return cls(**{name: float(value) for name, value in parse_qsl(parsed.query)})
+
+    def write(self, data):
+        with self.condition:
+            for line in bytes(data).decode().split("\r"):
+                if line.strip():
+                    self._command(line.split())
+            self.condition.notify_all()
+        return len(data)
+
+    def _command(self, words):
+        command, arguments = words[0], words[1:]
+        if command == "scanraw":
+            start_freq, stop_freq, points = float(arguments[0]), float(arguments[1]), int(arguments[2])
+            self.output += (" ".join(words) + "\r\n").encode()
+            self.scan = np.linspace(start_freq, stop_freq, points)
+            self._place_channels(start_freq, stop_freq)
+            self.started = time.monotonic()
+            self.sweeps = 0
+        elif command == "abort":
+            if not arguments:
+                self.scan = None
+                self.output.clear()  # Drop the snapshot that was being sent
+            self.output += (" ".join(words) + "\r\n").encode()
+        else:
+            if command in ("sweep", "spur", "rbw"):
+                self.settings[command] = " ".join(arguments)
+            self.output += (" ".join(words) + "\r\n").encode()
+
+    def _place_channels(self, start_freq, stop_freq):
+        # The channels stay where the first scan put them, so sub-band scans see the same carriers
+        span = stop_freq - start_freq
+        if self.carrier_start is None:
+            self.carrier_start = start_freq + span * 0.1
+        if self.carrier_spacing is None:
+            self.carrier_spacing = span * 0.8 / max(self.carriers - 1, 1)
+
+    def _spectrum(self, frequencies, sweep_times):
+        channels = self.hops[(sweep_times // self.hop_interval).astype(np.int64) % self.carriers]
+        carrier = self.carrier_start + channels * self.carrier_spacing
+
+        noise = self.noise_floor + self.noise * self.rng.standard_normal((len(sweep_times), len(frequencies)))
+        offset = (frequencies - carrier[:, None]) / self.carrier_width
+        signal = self.carrier_power - 10 * np.log10(np.e) * offset ** 2 / 2
+        # Add the powers of the noise and the carrier in mW
+        return 10 * np.log10(10 ** (noise / 10) + 10 ** (signal / 10))
+
+    def _generate(self):
+        """
+        Appends the sweeps that are due by now to the output.
+        """
+        if self.scan is None:
+            return
+        due = int((time.monotonic() - self.started) * self.rate)
+        if self.max_sweeps is not None:
+            due = min(due, self.max_sweeps)
+        if due <= self.sweeps:
+            return
+
+        data = self.frames(self.scan, self.sweeps, due - self.sweeps).view(np.uint8)
+
+        if self.corruption:
+            corrupted = np.flatnonzero(self.rng.random(len(data)) < self.corruption)
+            data[corrupted] = self.rng.integers(0, 256, len(corrupted), dtype=np.uint8)
+        if self.drop:
+            data = data[self.rng.random(len(data)) >= self.drop]
+        self.output += data.tobytes()
+        self.sweeps = due
+
+    def frames(self, frequencies, first, count):
+        """
+        Builds correctly framed scanraw snapshots, without corruption.
+
+        :param frequencies: Frequency of every point of the scan.
+        :param first: Number of the first sweep, which sets its time and the current channel.
+        :param count: Number of snapshots.
+        :return: Structured array of snapshot_dtype(points) snapshots.
+        """
+        self._place_channels(frequencies[0], frequencies[-1])
+        frames = np.zeros(count, dtype=snapshot_dtype(len(frequencies)))
+        frames['start'] = SNAPSHOT_START
+        frames['end'] = SNAPSHOT_END
+        frames['points']['marker'] = POINT_MARKER
+        dbm = self._spectrum(frequencies, np.arange(first, first + count) / self.rate)
+        frames['points']['value'] = np.clip(np.rint((dbm + 174) * 32), -32768, 32767)
+        return frames
+
+    def _next_sweep_time(self):
+        if self.scan is None or (self.max_sweeps is not None and self.sweeps >= self.max_sweeps):
+            return None
+        return self.started + (self.sweeps + 1) / self.rate
+
+    def _wait_for(self, size):
+        """
+        Waits until `size` bytes can be read, the read times out or is cancelled.
+
+        :return: The number of bytes that can be read now.
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.condition:
+            while True:
+                self._generate()
+                if len(self.output) >= size or self.cancelled:
+                    break
+                wake = self._next_sweep_time()
+                if deadline is not None:
+                    if time.monotonic() >= deadline:
+                        break
+                    wake = deadline if wake is None else min(wake, deadline)
+                elif wake is None:
+                    break  # Nothing more will arrive, like a device that stopped sending
+                self.condition.wait(max(wake - time.monotonic(), 0))
+            self.cancelled = False
+            return min(size, len(self.output))
+
+    def read(self, size=1):
+        count = self._wait_for(size)
+        with self.condition:
+            data = bytes(self.output[:count])
+            del self.output[:count]
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        count = self._wait_for(len(view))
+        with self.condition:
+            view[:count] = self.output[:count]
+            del self.output[:count]
+        return count
+
+    def readline(self):
+        with self.condition:
+            end = self.output.find(b"\n")
+            if end < 0:
+                return b""
+            line = bytes(self.output[:end + 1])
+            del self.output[:end + 1]
+        return line
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            self._generate()
+            return len(self.output)
+
+    def cancel_read(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.output.clear()
+
+    def close(self):
+        self.is_open = False
+
+if __name__ == "__main__":
+    # Measures whether the capture path keeps up with a simulated device at a given sweep rate
+    import os
+    import tempfile
+    from optparse import OptionParser
+    from capture import CaptureEngine
+    from recording import read_timestamps, sweep_interval_stats
+    from scan import tinySA
+
+    parser = OptionParser(usage="%prog: [options]")
+    parser.add_option("-r", "--rate", dest="rate", type="float", default=200, help="sweeps per second")
+    parser.add_option("-N", "--points", dest="points", type="int", default=25, help="scan points")
+    parser.add_option("-s", "--seconds", dest="seconds", type="float", default=5, help="capture duration")
+    parser.add_option("-c", "--corruption", dest="corruption", type="float", default=0,
+                      help="probability of a corrupted byte")
+    (opt, args) = parser.parse_args()
+
+    device = tinySA(f"{SIMULATOR_SCHEME}://?rate={opt.rate}&corruption={opt.corruption}"
+                    f"&max_sweeps={int(opt.rate * opt.seconds)}")
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "simulated.bin")
+        engine = CaptureEngine(device, filename, 865e6, 868e6, opt.points)
+        started = time.monotonic()
+        engine.run()
+        elapsed = time.monotonic() - started
+        stats = engine.stats()
+        intervals = sweep_interval_stats(read_timestamps(filename))
+
+    print(f"Requested {opt.rate:.0f} sweeps/s, captured {stats['snapshots_written']} snapshots in {elapsed:.2f}s "
+          f"({stats['snapshots_written'] / elapsed:.0f} sweeps/s), overruns {stats['overruns']}, "
+          f"ring high-water mark {stats['high_water']}/{stats['capacity']}")
+    if intervals:
+        print(f"Sweep interval mean {intervals['mean']:.3f}ms, p50 {intervals['p50']:.3f}ms, "
+              f"p99 {intervals['p99']:.3f}ms, max {intervals['max']:.3f}ms")
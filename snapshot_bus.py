@@ -0,0 +1,239 @@
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from bin_to_csv import decode_snapshots
+
+# Shared memory layout: BUS_MAGIC, the int64 header (points, capacity, published, closed), the float64 start
+# and stop frequencies, then for every slot its sequence number, its arrival time and its dBm values
+BUS_MAGIC = b"TSABUS01"
+HEADER_SIZE = 64
+POINTS, CAPACITY, PUBLISHED, CLOSED = range(4)
+
+def _layout(buffer, points, capacity):
+    header = np.ndarray(4, dtype=np.int64, buffer=buffer, offset=len(BUS_MAGIC))
+    band = np.ndarray(2, dtype=np.float64, buffer=buffer, offset=len(BUS_MAGIC) + header.nbytes)
+    sequences = np.ndarray(capacity, dtype=np.int64, buffer=buffer, offset=HEADER_SIZE)
+    times = np.ndarray(capacity, dtype=np.int64, buffer=buffer, offset=HEADER_SIZE + sequences.nbytes)
+    values = np.ndarray((capacity, points), dtype=np.float64, buffer=buffer,
+                        offset=HEADER_SIZE + sequences.nbytes + times.nbytes)
+    return header, band, sequences, times, values
+
+class SnapshotBus:
+    """
+    Publishes decoded snapshots into a shared memory ring, so any number of processes can read the same capture
+    (see SnapshotBusReader). The publisher never waits for the readers: a reader that falls more than
+    `capacity` snapshots behind loses the oldest ones and counts them as overruns.
+    Snapshot n goes to slot n % capacity. Its sequence number is written last, after the values,
+    then the published counter is advanced, so readers can detect slots overwritten while they read them.
+    """
+
+    def __init__(self, name, start_freq, end_freq, points, capacity=8192):
+        """
+        :param name: Name of the shared memory block, which the readers attach to.
+        :param points: Number of points in each snapshot.
+        :param capacity: Number of snapshots kept in the ring.
+        """
+        self.points = points
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * (16 + points * 8)
+        self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+        self.name = self.memory.name
+        self.memory.buf[:len(BUS_MAGIC)] = BUS_MAGIC
+        self.header, self.band, self.sequences, self.times, self.values = _layout(self.memory.buf, points, capacity)
+        self.header[:] = (points, capacity, 0, 0)
+        self.band[:] = (start_freq, end_freq)
+        self.sequences[:] = -1
+
+    def publish(self, snapshots, timestamps=None):
+        """
+        Appends snapshots to the ring.
+
+        :param snapshots: Array of dBm values (each row is a snapshot).
+        :param timestamps: Arrival times of the snapshots in nanoseconds, the current time if None.
+        """
+        snapshots = np.asarray(snapshots).reshape(-1, self.points)
+        if timestamps is None:
+            timestamps = np.full(len(snapshots), time.monotonic_ns(), dtype=np.int64)
+        # Snapshots beyond the capacity would be overwritten by the same batch
+        published = int(self.header[PUBLISHED]) + max(len(snapshots) - self.capacity, 0)
+        snapshots, timestamps = snapshots[-self.capacity:], np.asarray(timestamps)[-self.capacity:]
+        written = 0
+        while written < len(snapshots):
+            slot = (published + written) % self.capacity
+            count = min(len(snapshots) - written, self.capacity - slot)
+            slots = slice(slot, slot + count)
+            self.sequences[slots] = -1  # Being written
+            self.values[slots] = snapshots[written:written + count]
+            self.times[slots] = timestamps[written:written + count]
+            self.sequences[slots] = np.arange(published + written, published + written + count)
+            written += count
+        self.header[PUBLISHED] = published + len(snapshots)
+
+    def offer(self, snapshots, timestamps=None):
+        """
+        Capture sink: decodes a batch of raw scanraw snapshots and publishes it.
+
+        :param snapshots: Bytes-like object of whole scanraw snapshots.
+        :param timestamps: Arrival times of the snapshots in nanoseconds, the current time if None.
+        """
+        if timestamps is None:
+            self.publish(decode_snapshots(snapshots, self.points))
+        else:
+            timestamps, snapshots = decode_snapshots(snapshots, self.points, timestamps)
+            self.publish(snapshots, timestamps)
+
+    def close(self):
+        """
+        Tells the readers that the capture ended and removes the shared memory block.
+        Readers that are attached keep their mapping until they close it.
+        """
+        self.header[CLOSED] = 1
+        del self.header, self.band, self.sequences, self.times, self.values
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    # Before Python 3.13 attaching registers the block with the resource tracker, which removes it when
+    # the reader exits. Unregistering afterwards would break the publisher's tracker in forked readers.
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+class SnapshotBusReader:
+    """
+    Reads the snapshots of a SnapshotBus from another process. Each reader keeps its own cursor,
+    so readers at different speeds do not affect each other or the publisher.
+    """
+
+    def __init__(self, name, from_start=False, poll_interval=0.005):
+        """
+        :param name: Name of the bus.
+        :param from_start: Start with the oldest snapshot still in the ring instead of the next published one.
+        :param poll_interval: Time in seconds between two checks for new snapshots while waiting.
+        """
+        self.memory = _attach(name)
+        if bytes(self.memory.buf[:len(BUS_MAGIC)]) != BUS_MAGIC:
+            self.memory.close()
+            raise ValueError(f"{name} is not a snapshot bus")
+        header = np.ndarray(4, dtype=np.int64, buffer=self.memory.buf, offset=len(BUS_MAGIC))
+        self.points, self.capacity = int(header[POINTS]), int(header[CAPACITY])
+        self.header, band, self.sequences, self.times, self.values = _layout(self.memory.buf, self.points,
+                                                                             self.capacity)
+        self.frequencies = np.linspace(band[0], band[1], self.points)
+        self.poll_interval = poll_interval
+        published = int(self.header[PUBLISHED])
+        self.cursor = max(published - self.capacity, 0) if from_start else published
+        self.overruns = 0
+
+    def closed(self):
+        """
+        :return: True when the publisher has closed the bus and every snapshot was read.
+        """
+        return bool(self.header[CLOSED]) and self.cursor >= self.header[PUBLISHED]
+
+    def read(self, max_snapshots=None, timeout=None, copy=True):
+        """
+        Returns the next snapshots, at most up to the end of the ring, waiting for them if there are none.
+        Snapshots that were overwritten before they could be read are skipped and added to `overruns`.
+
+        :param max_snapshots: Maximum number of snapshots to return.
+        :param timeout: Maximum time in seconds to wait for a snapshot, forever if None.
+        :param copy: Return copies. Otherwise the arrays are views into the ring, which stay valid until the
+                     publisher wraps around; check valid(sequence) after using them.
+        :return: A tuple of (sequence of the first snapshot, timestamps, snapshots), empty on timeout or
+                 when the bus is closed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            published = int(self.header[PUBLISHED])
+            if published > self.cursor or self.header[CLOSED]:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(self.poll_interval)
+
+        while True:
+            oldest = published - self.capacity
+            if self.cursor < oldest:
+                self.overruns += oldest - self.cursor
+                self.cursor = oldest
+            slot = self.cursor % self.capacity
+            count = min(published - self.cursor, self.capacity - slot)
+            if max_snapshots is not None:
+                count = min(count, max_snapshots)
+            first = self.cursor
+            slots = slice(slot, slot + count)
+            times, values = self.times[slots], self.values[slots]
+            if copy:
+                times, values = times.copy(), values.copy()
+            # Slots overwritten during the copy have a newer (or the in-progress -1) sequence number.
+            # The publisher overwrites them in order, so they are at the beginning of the run.
+            overwritten = np.flatnonzero(self.sequences[slots] != np.arange(first, first + count))
+            if not len(overwritten):
+                self.cursor += count
+                return first, times, values
+            lost = int(overwritten[-1]) + 1
+            self.overruns += lost
+            self.cursor = first + lost
+            published = int(self.header[PUBLISHED])
+
+    def valid(self, sequence):
+        """
+        :return: True if snapshot `sequence` is still in the ring, i.e. views returned by read(copy=False) from
+                 that snapshot on have not been overwritten.
+        """
+        return sequence >= self.header[PUBLISHED] - self.capacity
+
+    def close(self):
+        del self.header, self.sequences, self.times, self.values
+        self.memory.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+if __name__ == "__main__":
+    # Example consumer: finds carriers in a capture published by scan.py -b NAME, from a separate process
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fhss_analyzers"))
+    from average_snaphot_analyzer import StreamingAverager, find_carriers
+
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("Usage: python snapshot_bus.py <bus name> [threshold] [report every]")
+        sys.exit(1)
+
+    threshold = float(sys.argv[2]) if len(sys.argv) > 2 else -40
+    report_every = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    def report(reader, averager):
+        if averager.num_snapshots:
+            carriers, num_carriers = find_carriers(reader.frequencies, averager.average(), threshold / 2)
+            print(f"[{averager.num_snapshots} snapshots] Number of carriers: {num_carriers} "
+                  f"Carrier frequencies: {carriers} (overruns {reader.overruns})")
+
+    with SnapshotBusReader(sys.argv[1]) as reader:
+        averager = StreamingAverager(reader.points, threshold)
+        next_report = report_every
+        while not reader.closed():
+            # Copies: the averager must not see rows that the publisher overwrites while it sums them
+            _, _, snapshots = reader.read(timeout=1.0)
+            averager.update(snapshots)
+            if averager.num_snapshots >= next_report:
+                report(reader, averager)
+                next_report = averager.num_snapshots + report_every
+        report(reader, averager)
@@ -0,0 +1,182 @@
+import time
+import numpy as np
+from bin_to_csv import SnapshotParser
+from recording import MISSING_CODE, RecordingWriter, dbm_to_code, write_source_table
+
+class Segment:
+    """
+    A sub-band swept by the scheduler with its own number of points, RBW and revisit priority.
+    """
+
+    def __init__(self, start_freq, stop_freq, points, rbw=None, priority=1.0):
+        """
+        :param start_freq: Start frequency in Hz.
+        :param stop_freq: Stop frequency in Hz.
+        :param points: Number of points in each sweep of the segment.
+        :param rbw: RBW in kHz set before sweeping the segment, the current RBW is kept if None.
+        :param priority: Relative revisit rate of the segment when it is quiet.
+        """
+        self.start_freq = start_freq
+        self.stop_freq = stop_freq
+        self.points = points
+        self.rbw = rbw
+        self.priority = priority
+        self.frequencies = np.linspace(start_freq, stop_freq, points)
+        self.occupancy = 0.0  # Smoothed fraction of recent values above the threshold
+        self.credit = 0.0
+        self.visits = 0
+        self.snapshots = 0
+
+    def describe(self):
+        return {"start_freq": self.start_freq, "stop_freq": self.stop_freq, "points": self.points,
+                "rbw": self.rbw, "priority": self.priority, "visits": self.visits, "snapshots": self.snapshots}
+
+def split_band(start_freq, stop_freq, span, points, rbw=None):
+    """
+    Splits a wide range into adjacent segments of at most `span` Hz.
+
+    :param span: Maximum width of a segment in Hz.
+    :param points: Number of points in each segment.
+    :param rbw: RBW in kHz of every segment.
+    :return: List of Segment covering start_freq to stop_freq.
+    """
+    count = max(1, int(np.ceil((stop_freq - start_freq) / span)))
+    edges = np.linspace(start_freq, stop_freq, count + 1)
+    return [Segment(float(low), float(high), points, rbw) for low, high in zip(edges[:-1], edges[1:])]
+
+class SweepScheduler:
+    """
+    Sweeps a list of segments with one tinySA, one scanraw command per visit.
+    Segments are visited in smooth weighted round-robin order; the weight of a segment is its priority
+    raised by its recent occupancy, so busy segments are swept more often than quiet ones.
+    Snapshots of all segments are stitched into one recording of raw values over the union of the segment
+    frequencies; the columns of the other segments hold MISSING_CODE, read back as NaN.
+    """
+
+    def __init__(self, device, segments, threshold=-80, sweeps_per_visit=10, busy_weight=4.0, smoothing=0.3,
+                 metrics=None):
+        """
+        :param device: An opened or openable tinySA instance with abort enabled.
+        :param segments: List of Segment to sweep.
+        :param threshold: dBm level above which a value counts as occupied.
+        :param sweeps_per_visit: Number of snapshots taken before switching to the next segment.
+        :param busy_weight: Extra weight of a fully occupied segment, relative to its priority.
+        :param smoothing: Weight of the last visit in the occupancy of a segment.
+        :param metrics: Optional metrics.Metrics recording the serial reads (see scanraw_snapshots) and the visits.
+        """
+        self.device = device
+        self.segments = list(segments)
+        self.threshold = threshold
+        self.sweeps_per_visit = sweeps_per_visit
+        self.busy_weight = busy_weight
+        self.smoothing = smoothing
+        self.metrics = metrics
+        self.frequencies = np.unique(np.concatenate([segment.frequencies for segment in self.segments]))
+        self.columns = [np.searchsorted(self.frequencies, segment.frequencies) for segment in self.segments]
+        self.skipped = 0
+        self.finished = False
+
+    def weight(self, segment):
+        return segment.priority * (1 + self.busy_weight * segment.occupancy)
+
+    def next_segment(self):
+        """
+        Picks the index of the next segment to sweep (smooth weighted round-robin).
+        """
+        weights = [self.weight(segment) for segment in self.segments]
+        for segment, weight in zip(self.segments, weights):
+            segment.credit += weight
+        index = max(range(len(self.segments)), key=lambda i: self.segments[i].credit)
+        self.segments[index].credit -= sum(weights)
+        return index
+
+    def visit(self, segment):
+        """
+        Sweeps one segment for sweeps_per_visit snapshots and updates its occupancy.
+
+        :return: A tuple of (timestamps, snapshots) with the arrival time and raw int16 values of every snapshot.
+        """
+        if segment.rbw is not None and self.device.settings.get("rbw") != segment.rbw:
+            self.device.rbw(segment.rbw)
+
+        # Parsing with resynchronization drops the bytes left over from the previous segment
+        parser = SnapshotParser(segment.points, codes=True)
+        times, snapshots = [], []
+        received = 0
+        stream = self.device.scanraw_snapshots(segment.start_freq, segment.stop_freq, segment.points,
+                                               mode="view", timestamps=True, metrics=self.metrics)
+        for arrival, data in stream:
+            block = parser.feed(data)
+            if len(block):
+                snapshots.append(block)
+                times.append(np.full(len(block), arrival, dtype=np.int64))
+                received += len(block)
+            if received >= self.sweeps_per_visit:
+                stream.close()
+                self.device.stop_scan()
+                break
+        else:
+            self.finished = True  # The device stopped sending data or the user pressed Ctrl+C
+
+        self.skipped += parser.skipped
+        segment.visits += 1
+        if self.metrics is not None:
+            self.metrics.inc("segment_visits_total")
+            self.metrics.inc("skipped_bytes_total", parser.skipped)
+        if not received:
+            return np.empty(0, dtype=np.int64), np.empty((0, segment.points), dtype=np.int16)
+        times, snapshots = np.concatenate(times), np.concatenate(snapshots)
+        segment.snapshots += len(snapshots)
+        busy = np.count_nonzero(snapshots > dbm_to_code(self.threshold)) / snapshots.size
+        segment.occupancy += self.smoothing * (busy - segment.occupancy)
+        return times, snapshots
+
+    def stitch(self, index, snapshots):
+        """
+        Places snapshots of one segment on the shared frequency axis, the other columns are MISSING_CODE.
+        """
+        block = np.full((len(snapshots), len(self.frequencies)), MISSING_CODE, dtype=np.int16)
+        block[:, self.columns[index]] = snapshots
+        return block
+
+    def run(self, writer, max_visits=None):
+        """
+        Sweeps the segments until the device stops sending data, the user presses Ctrl+C or max_visits is reached.
+
+        :param writer: RecordingWriter over self.frequencies receiving the stitched snapshots.
+        :param max_visits: Maximum total number of segment visits, unlimited if None.
+        """
+        visits = 0
+        try:
+            while not self.finished and (max_visits is None or visits < max_visits):
+                index = self.next_segment()
+                times, snapshots = self.visit(self.segments[index])
+                visits += 1
+                if len(snapshots):
+                    writer.write(self.stitch(index, snapshots), times, np.full(len(times), index))
+        except KeyboardInterrupt:
+            print("Data reading interrupted by user.")
+            self.device.stop_scan()
+
+    def record(self, filename, max_visits=None):
+        """
+        Sweeps the segments into a recording, one row per snapshot with the segment index in its sources sidecar.
+        The segments, with their visits, are described in the source table sidecar (see read_source_table).
+
+        :param filename: Path to the .rec recording.
+        :param max_visits: Maximum total number of segment visits, unlimited if None.
+        :return: Number of snapshots written.
+        """
+        start_time = time.time() * 1000
+        # Hundreds of segments do not fit into the header, they are described in a sidecar
+        write_source_table(filename, [segment.describe() for segment in self.segments])
+        with RecordingWriter(filename, self.frequencies[0], self.frequencies[-1], len(self.frequencies),
+                             dtype=np.int16, frequencies=self.frequencies, codes=True, missing_code=MISSING_CODE,
+                             **self.device.settings) as writer:
+            self.run(writer, max_visits)
+            writer.close(capture_duration_ms=time.time() * 1000 - start_time, skipped_bytes=self.skipped)
+        write_source_table(filename, [segment.describe() for segment in self.segments])
+        for segment in self.segments:
+            print(f"{segment.start_freq:.0f}-{segment.stop_freq:.0f} Hz: {segment.visits} visits, "
+                  f"{segment.snapshots} snapshots, occupancy {segment.occupancy:.3f}")
+        return writer.snapshots
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts are run from the repository root and the analyzers from fhss_analyzers
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "fhss_analyzers")]
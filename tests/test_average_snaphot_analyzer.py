@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from average_snaphot_analyzer import remove_local_minima
+
+def reference_remove_local_minima(averaged_snapshot, threshold):
+    # remove_local_minima before the worklist: rescans from i-1 after every replacement
+    i = 1
+    while i < len(averaged_snapshot) - 1:
+        if (averaged_snapshot[i] < averaged_snapshot[i - 1] and
+            averaged_snapshot[i] < averaged_snapshot[i + 1] and
+            averaged_snapshot[i] > threshold):
+            averaged_snapshot[i] = (averaged_snapshot[i - 1] + averaged_snapshot[i + 1]) / 2
+            i = max(1, i - 1)
+        else:
+            i += 1
+    return averaged_snapshot
+
+def random_spectra(rng, count):
+    for _ in range(count):
+        points = int(rng.integers(0, 64))
+        yield rng.normal(-80, 15, points)  # Gaussian
+        yield rng.integers(-3000, -1500, points) / 32.0 - 100  # Quantized to raw tinySA codes
+        plateaus = np.repeat(rng.normal(-70, 10, points // 8 + 1), 8)[:points]
+        yield plateaus + np.where(rng.random(points) < 0.1, -20.0, 0.0)  # Plateaus with notches
+        with_gaps = rng.normal(-60, 20, points)
+        with_gaps[rng.random(points) < 0.1] = np.nan  # Points without values above the averaging threshold
+        yield with_gaps
+
+@pytest.mark.parametrize("threshold", [-95, -80, -65, -50])
+def test_remove_local_minima_matches_reference(threshold):
+    rng = np.random.default_rng(11)
+    for spectrum in random_spectra(rng, 100):
+        expected = reference_remove_local_minima(spectrum.copy(), threshold)
+        np.testing.assert_array_equal(remove_local_minima(spectrum.copy(), threshold), expected)
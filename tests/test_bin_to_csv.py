@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from bin_to_csv import SnapshotParser
+
+POINTS = 10
+
+def scanraw_stream(codes):
+    return b''.join(b'{' + b''.join(b'x' + int(code).to_bytes(2, 'little', signed=True) for code in row) + b'}'
+                    for row in codes)
+
+@pytest.mark.parametrize("split", range(1, 40, 3))
+def test_gap_split_across_feeds_is_counted_once(split):
+    codes = np.random.default_rng(0).integers(-4000, -1000, (4, POINTS), dtype=np.int16)
+    corrupt = b'x{}' * 20 + b'{xx'
+    stream = scanraw_stream(codes[:2]) + corrupt + scanraw_stream(codes[2:])
+    cut = 2 * (POINTS * 3 + 2) + split
+
+    parser = SnapshotParser(POINTS, codes=True)
+    snapshots = np.concatenate((parser.feed(stream[:cut]), parser.feed(stream[cut:])))
+    parser.finish()
+
+    np.testing.assert_array_equal(snapshots, codes)
+    assert parser.skipped == len(corrupt)
+    assert parser.resyncs == 1
@@ -0,0 +1,34 @@
+import tracemalloc
+import numpy as np
+from hop_duration import occupancy_matrix
+from recording import DbmSnapshots, RecordingWriter, load_snapshots
+
+def write_codes_recording(filename, snapshots=20000, points=100):
+    codes = np.random.default_rng(0).integers(-4000, -1000, (snapshots, points), dtype=np.int16)
+    with RecordingWriter(str(filename), 865e6, 870e6, points, dtype=np.int16, codes=True) as recording:
+        recording.write(codes)
+    return codes
+
+def test_load_snapshots_keeps_codes_memory_mapped(tmp_path):
+    filename = tmp_path / "capture.rec"
+    codes = write_codes_recording(filename)
+    tracemalloc.start()
+    try:
+        _, snapshots = load_snapshots(str(filename))
+        _, head = load_snapshots(str(filename), 100)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < codes.nbytes  # Not even the codes were read, let alone converted to float64
+    for view, count in ((snapshots, len(codes)), (head, 100)):
+        assert isinstance(view, DbmSnapshots) and isinstance(view.codes, np.memmap)
+        assert view.shape == (count, codes.shape[1])
+    np.testing.assert_array_equal(head[:], codes[:100] / 32.0 - 174)
+
+def test_occupancy_matrix_in_code_space(tmp_path):
+    filename = tmp_path / "capture.rec"
+    codes = write_codes_recording(filename)
+    _, snapshots = load_snapshots(str(filename))
+    for threshold in (-150, -100.5, -100.51):
+        np.testing.assert_array_equal(occupancy_matrix(snapshots, threshold),
+                                      occupancy_matrix(codes / 32.0 - 174, threshold))
@@ -0,0 +1,161 @@
+import sys
+import numpy as np
+from recording import batch_rows, load_snapshots, read_sweep_period
+
+REDUCTIONS = ("max", "mean")
+
+class WaterfallAccumulator:
+    """
+    Time-decimated waterfall of a snapshot stream with a fixed number of rows.
+    Each row reduces `snapshots_per_row` consecutive snapshots (per-frequency max or mean, NaN values ignored).
+    When the rows are full, adjacent rows are merged and snapshots_per_row is doubled, so memory stays
+    at max_rows x points however long the stream is.
+    """
+
+    def __init__(self, points, max_rows=1000, reduction="max", snapshots_per_row=1):
+        """
+        :param points: Number of points in each snapshot.
+        :param max_rows: Maximum number of rows of the waterfall.
+        :param reduction: "max" keeps short carriers visible, "mean" shows the average power.
+        :param snapshots_per_row: Initial number of snapshots per row, e.g. ceil(length / max_rows) for a recording.
+        """
+        if reduction not in REDUCTIONS:
+            raise ValueError(f"Unknown waterfall reduction {reduction}")
+        self.points = points
+        self.max_rows = max_rows
+        self.reduction = reduction
+        self.snapshots_per_row = max(1, int(snapshots_per_row))
+        self.num_snapshots = 0
+        if reduction == "max":
+            self.values = np.full((max_rows, points), np.nan)
+        else:
+            self.sums = np.zeros((max_rows, points))
+            self.counts = np.zeros((max_rows, points), dtype=np.int64)
+
+    def update(self, snapshots):
+        """
+        Adds a batch of consecutive snapshots.
+
+        :param snapshots: Array of snapshot values (each row is a snapshot).
+        :return: self, so updates can be chained.
+        """
+        snapshots = np.asarray(snapshots, dtype=np.float64).reshape(-1, self.points)
+        while len(snapshots):
+            free = self.max_rows * self.snapshots_per_row - self.num_snapshots
+            if free <= 0:
+                self._merge_rows()
+                continue
+            chunk, snapshots = snapshots[:free], snapshots[free:]
+
+            # Reduce the runs of snapshots falling into the same row in one call
+            rows = (self.num_snapshots + np.arange(len(chunk))) // self.snapshots_per_row
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(rows)) + 1))
+            rows = rows[starts]
+            if self.reduction == "max":
+                self.values[rows] = np.fmax(self.values[rows], np.fmax.reduceat(chunk, starts, axis=0))
+            else:
+                valid = ~np.isnan(chunk)
+                self.sums[rows] += np.add.reduceat(np.where(valid, chunk, 0), starts, axis=0)
+                self.counts[rows] += np.add.reduceat(valid, starts, axis=0)
+            self.num_snapshots += len(chunk)
+        return self
+
+    def _merge_rows(self):
+        pairs = self.max_rows // 2
+        if self.reduction == "max":
+            arrays = [(self.values, np.fmax, np.nan)]
+        else:
+            arrays = [(self.sums, np.add, 0), (self.counts, np.add, 0)]
+        for array, merge, empty in arrays:
+            merged = merge(array[0:2 * pairs:2], array[1:2 * pairs:2])
+            if self.max_rows % 2:
+                merged = np.concatenate((merged, array[-1:]))
+            array[:len(merged)] = merged
+            array[len(merged):] = empty
+        self.snapshots_per_row *= 2
+
+    def image(self, columns=None):
+        """
+        Returns the waterfall, one row per snapshots_per_row snapshots (the last row may be partial).
+
+        :param columns: Reduce the frequencies to at most this number of columns with the same reduction.
+        :return: Array of rows x columns values.
+        """
+        rows = -(-self.num_snapshots // self.snapshots_per_row)
+        if self.reduction == "max":
+            image = self.values[:rows].copy()
+        else:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                image = np.where(self.counts[:rows] > 0, self.sums[:rows] / self.counts[:rows], np.nan)
+        if columns is not None and self.points > columns:
+            starts = column_starts(self.points, columns)
+            if self.reduction == "max":
+                image = np.fmax.reduceat(image, starts, axis=1)
+            else:
+                with np.errstate(invalid='ignore'):
+                    image = np.add.reduceat(np.nan_to_num(image), starts, axis=1) / \
+                            np.add.reduceat(~np.isnan(image), starts, axis=1)
+        return image
+
+def column_starts(points, columns):
+    """
+    Returns the first point of each of `columns` groups of nearly equal size.
+    """
+    return np.linspace(0, points, columns, endpoint=False).astype(np.intp)
+
+def waterfall(filename, rows=1000, columns=None, reduction="max", batch_size=None):
+    """
+    Builds a waterfall of a recording (memory-mapped) or a CSV file (through its binary cache), batch by batch.
+
+    :param filename: Path to a .rec recording or a CSV file.
+    :param rows: Number of rows of the waterfall, e.g. the screen height.
+    :param columns: Number of frequency columns, all points if None.
+    :param reduction: "max" or "mean" over the snapshots of a row.
+    :param batch_size: Number of snapshots read at once, BATCH_BYTES of float64 values if None.
+    :return: A tuple of (frequencies, image, snapshots_per_row) where frequencies label the image columns.
+    """
+    frequencies, snapshots = load_snapshots(filename)
+    accumulator = WaterfallAccumulator(len(frequencies), rows, reduction, -(-len(snapshots) // rows))
+    batch_size = batch_size or batch_rows(len(frequencies))
+    for start in range(0, len(snapshots), batch_size):
+        accumulator.update(snapshots[start:start + batch_size])
+    if columns is not None and len(frequencies) > columns:
+        frequencies = frequencies[column_starts(len(frequencies), columns)]
+    return frequencies, accumulator.image(columns), accumulator.snapshots_per_row
+
+def plot_waterfall(filename, rows=1000, columns=None, reduction="max"):
+    """
+    Shows the waterfall of a recording or CSV file, time going down.
+    """
+    import matplotlib.pyplot as plt
+
+    frequencies, image, snapshots_per_row = waterfall(filename, rows, columns, reduction)
+    if not len(image):
+        print("No snapshots available for plotting.")
+        return
+
+    scan_period = read_sweep_period(filename)
+    duration = len(image) * snapshots_per_row
+    if scan_period is not None:
+        duration *= scan_period
+
+    plt.figure(figsize=(10, 8))
+    plt.imshow(image, aspect='auto', interpolation='nearest', cmap='viridis',
+               extent=(frequencies[0], frequencies[-1], duration, 0))
+    plt.colorbar(label=f"dBm ({reduction} of {snapshots_per_row} snapshots per row)")
+    plt.title(f"Waterfall of {filename}")
+    plt.xlabel("Frequency (Hz)")
+    plt.ylabel("Time (s)" if scan_period is not None else "Snapshot")
+    plt.show()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("Usage: python waterfall.py <recording or csv file> [rows] [max|mean]")
+        sys.exit(1)
+
+    filename = sys.argv[1]
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    reduction = sys.argv[3] if len(sys.argv) > 3 else "max"
+
+    plot_waterfall(filename, rows, reduction=reduction)